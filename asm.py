@@ -2,12 +2,16 @@
 
 from __future__ import print_function
 
+from array import array
 import struct
 import re
 import sys
 import argparse
 import os
 import codecs
+import hashlib
+import io
+import shutil
 
 
 def disjunction(*lst):
@@ -124,72 +128,386 @@ ADDR_MAP = {
 }
 
 
+# the named groups of each operand of line_regex, with the group holding
+# the value of indexed operands and the function giving the operand's code
+# and next word
+OPERAND_GROUPS = dict((prefix, [(prefix + name, prefix + name[:-len("_index")] if name.endswith("_index") else None, address)
+                                for name, address in ADDR_MAP.items()])
+                      for prefix in ("op1_", "op2_", "op3_"))
+
+# words buffered before being written out
+FLUSH_WORDS = 4096
+
+
 def handle(token_dict, prefix):
-    token = [t for t in token_dict.keys() if t.startswith(prefix) and token_dict[t] is not None][0]
-    suffix = token[len(prefix):]
-    v = token_dict[token[:token.rfind("_index")]] if token.endswith("_index") else None
-    return ADDR_MAP[suffix](token_dict[token], v)
+    for name, value_name, address in OPERAND_GROUPS[prefix]:
+        token = token_dict[name]
+        if token is not None:
+            return address(token, token_dict[value_name] if value_name is not None else None)
+
+
+def parse_line_regex(line):
+    """
+        Parse a line with line_regex, as parse_line does with the
+        tokenizer, which is the faster of the two
+    """
+    mo = line_regex.match(line)
+    if mo is None:
+        return None
+
+    token_dict = mo.groupdict()
+    o = x = y = None
+    words = []
+    if token_dict["basic"] is not None:
+        o = OPCODES[token_dict["basic"].upper()]
+        a, x = handle(token_dict, "op1_")
+        b, y = handle(token_dict, "op2_")
+    elif token_dict["nonbasic"] is not None:
+        o, a = 0x00, 0x01
+        b, y = handle(token_dict, "op3_")
+    elif token_dict["data"] is not None:
+        for datum in re.findall("""("[^"]*"|0x[0-9A-Fa-f]{1,4}|\d+)""", token_dict["data"]):
+            if datum.startswith("\""):
+                words.extend(ord(ch) for ch in datum[1:-1])
+            elif datum.startswith("0x"):
+                words.append(int(datum[2:], 16))
+            else:
+                words.append(int(datum))
+
+    if o is not None:
+        words.append((b << 10) + (a << 4) + o)
+    if x is not None:
+        words.append(x)
+    if y is not None:
+        words.append(y)
+    return token_dict["label"], words
+
+
+# the tokens of a line: whitespace, a comment, a word, a string, which is
+# in error without its closing quote, or any other character
+TOKEN_REGEX = re.compile(r'''\s+|;.*|\w+|"[^"]*"?|.''')
+
+HEX_WORD = re.compile(r"0x[0-9A-Fa-f]{1,4}\Z")
+DECIMAL_WORD = re.compile(r"\d+\Z")
+
+# mnemonics and registers, like line_regex, in upper or lower case
+BASIC_OPCODES = dict(list(OPCODES.items()) + [(name.lower(), code) for name, code in OPCODES.items()])
+REGISTERS = dict(list(IDENTIFIERS.items()) + [(name.lower(), code) for name, code in IDENTIFIERS.items()])
+GENERAL_REGISTERS_CODES = dict((name, code) for name, code in REGISTERS.items() if code < 0x08)
+MNEMONICS = frozenset(list(BASIC_OPCODES) + ["JSR", "jsr", "DAT", "dat"])
+
+
+def is_word(token):
+    return token[:1].isalnum() or token[:1] == "_"
+
+
+def parse_operand(tokens, i):
+    """
+        Parse the operand at ``tokens[i]``, returning its code, its next
+        word or None and the index of the token after it, or None if it
+        is in error
+    """
+    token = tokens[i]
+    if token != "[":
+        if not is_word(token):
+            return None
+        if token in REGISTERS:
+            return REGISTERS[token], None, i + 1
+        if HEX_WORD.match(token):
+            return clamped_value(int(token[2:], 16)) + (i + 1,)
+        if DECIMAL_WORD.match(token):
+            return clamped_value(int(token)) + (i + 1,)
+        return 0x1F, token, i + 1
+
+    i += 1
+    if tokens[i].isspace():
+        i += 1
+    token = tokens[i]
+    if not is_word(token):
+        return None
+    i += 1
+    if tokens[i].isspace():
+        i += 1
+    if tokens[i] == "]":
+        if token in GENERAL_REGISTERS_CODES:
+            return 0x08 + GENERAL_REGISTERS_CODES[token], None, i + 1
+        if HEX_WORD.match(token):
+            return 0x1E, int(token[2:], 16), i + 1
+        if DECIMAL_WORD.match(token):
+            return 0x1E, int(token), i + 1
+        return 0x1E, token, i + 1
+    if tokens[i] != "+":
+        return None
+
+    i += 1
+    if tokens[i].isspace():
+        i += 1
+    index = tokens[i]
+    if index not in GENERAL_REGISTERS_CODES:
+        return None
+    i += 1
+    if tokens[i].isspace():
+        i += 1
+    if tokens[i] != "]":
+        return None
+    code = 0x10 + GENERAL_REGISTERS_CODES[index]
+    if HEX_WORD.match(token):
+        return code, int(token[2:], 16), i + 1
+    if DECIMAL_WORD.match(token):
+        # read as hex, as ADDR_MAP does
+        return code, int(token, 16), i + 1
+    return code, token, i + 1
+
+
+def parse_instruction(tokens, i):
+    """
+        Parse the instruction starting at ``tokens[i]`` to the end of the
+        line, returning its words, none for an empty line, or None if it
+        is in error
+    """
+    mnemonic = tokens[i]
+    if not mnemonic:
+        return []
+    if mnemonic not in MNEMONICS or not tokens[i + 1].isspace():
+        return None
+    i += 2
+
+    if mnemonic in BASIC_OPCODES:
+        operand = parse_operand(tokens, i)
+        if operand is None:
+            return None
+        a, x, i = operand
+        if tokens[i].isspace():
+            i += 1
+        if tokens[i] != ",":
+            return None
+        i += 1
+        if tokens[i].isspace():
+            i += 1
+        operand = parse_operand(tokens, i)
+        if operand is None:
+            return None
+        b, y, i = operand
+        words = [(b << 10) + (a << 4) + BASIC_OPCODES[mnemonic]]
+        if x is not None:
+            words.append(x)
+    elif mnemonic in ("JSR", "jsr"):
+        operand = parse_operand(tokens, i)
+        if operand is None:
+            return None
+        b, y, i = operand
+        words = [(b << 10) + (0x01 << 4)]
+    else:
+        words = y = None
+        data = []
+        while True:
+            datum = tokens[i]
+            if datum[:1] == '"':
+                if len(datum) < 2 or datum[-1] != '"':
+                    return None
+                data.extend(ord(ch) for ch in datum[1:-1])
+            elif HEX_WORD.match(datum):
+                data.append(int(datum[2:], 16))
+            elif DECIMAL_WORD.match(datum):
+                data.append(int(datum))
+            else:
+                return None
+            i += 1
+            # there is no whitespace before the comma
+            if tokens[i] != ",":
+                break
+            i += 1
+            if tokens[i].isspace():
+                i += 1
+        words = data
+
+    if y is not None:
+        words.append(y)
+    if tokens[i].isspace():
+        i += 1
+    if tokens[i]:
+        return None
+    return words
+
+
+def parse_line(line):
+    """
+        Parse a line, returning its label, or None, and its words, where
+        label names stand for their addresses, or None if it is in error
+
+        The line is split into tokens with TOKEN_REGEX and parsed by token,
+        accepting what line_regex does.
+    """
+    tokens = TOKEN_REGEX.findall(line)
+    # a comment can only be followed by the newline
+    trailing = tokens.pop() if tokens and tokens[-1].isspace() else ""
+    if tokens and tokens[-1][0] == ";":
+        if trailing not in ("", "\n"):
+            return None
+        tokens.pop()
+    # the empty string ends the line
+    tokens.append("")
+
+    i = 1 if tokens[0].isspace() else 0
+    label = None
+    if tokens[i] == ":":
+        label = tokens[i + 1]
+        if not is_word(label):
+            return None
+        i += 2
+        spaced = tokens[i].isspace()
+        if spaced:
+            i += 1
+        words = parse_instruction(tokens, i)
+        if words is None and spaced and len(label) > 3 and label[-3:] in MNEMONICS:
+            # line_regex backtracks to a label followed by a mnemonic
+            # without whitespace between them
+            words = parse_instruction([label[-3:]] + tokens[i - 1:], 0)
+            label = label[:-3]
+    else:
+        words = parse_instruction(tokens, i)
+    if words is None:
+        return None
+    return label, words
 
 
 def report_error(filename, lineno, error):
     print("%s:%i: %s" % (filename, lineno, error), file=sys.stderr)
 
 
+class Emitter:
+    """
+        Writes assembled words to a binary file as they come
+
+        A word naming a label is written as 0 and listed in ``fixups``
+        with its address, to be patched by ``finish`` once every label is
+        known, so labels can be used before they are defined.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.words = array("H")
+        # address of the first word in self.words
+        self.flushed = 0
+        self.labels = {}
+        self.fixups = []
+
+    def address(self):
+        return self.flushed + len(self.words)
+
+    def emit(self, word, lineno):
+        if isinstance(word, int):
+            self.words.append(word)
+        else:
+            self.fixups.append((self.address(), word, lineno))
+            self.words.append(0)
+        if len(self.words) >= FLUSH_WORDS:
+            self.flush()
+
+    def flush(self):
+        words = self.words
+        if sys.byteorder == "little":
+            words.byteswap()
+        words.tofile(self.f)
+        self.flushed += len(words)
+        self.words = array("H")
+
+    def finish(self, filename):
+        """
+            Write the rest of the words and patch in the labels, returning
+            False after reporting any undefined
+        """
+        self.flush()
+        for address, label, lineno in self.fixups:
+            if label not in self.labels:
+                report_error(filename, lineno, "Undefined label '%s'" % label)
+                return False
+            if self.labels[label] > 0xFFFF:
+                report_error(filename, lineno, "Label '%s' is out of memory" % label)
+                return False
+            self.f.seek(address * 2)
+            self.f.write(struct.pack(">H", self.labels[label]))
+        return True
+
+
+def assemble(lines, emitter, filename, parse=parse_line):
+    """
+        Assemble ``lines`` in a single pass, handing the words to
+        ``emitter`` and recording the address of every label in it; the
+        lines are parsed with ``parse``, parse_line or parse_line_regex
+
+        Returns False if a line is in error, stopping at it; the words of
+        the lines before it are kept.
+    """
+    labels = emitter.labels
+    for lineno, line in enumerate(lines, start=1):
+        if lineno == 1:
+            line = line.lstrip(codecs.BOM_UTF8.decode("utf-8") if isinstance(line, type(u"")) else codecs.BOM_UTF8)
+
+        parsed = parse(line)
+        if parsed is None:
+            report_error(filename, lineno, "Syntax error: '%s'" % line.strip())
+            return False
+
+        label, words = parsed
+        if label is not None:
+            labels[label] = emitter.address()
+
+        try:
+            for word in words:
+                emitter.emit(word, lineno)
+        except OverflowError:
+            report_error(filename, lineno, "Value out of range: '%s'" % line.strip())
+            return False
+    return True
+
+
+def write_symbols(path, labels):
+    with open(path, "w") as f:
+        for label, address in sorted(labels.items(), key=lambda item: item[1]):
+            f.write("%04x %s\n" % (address, label))
+
+
+def cache_key(data):
+    """Hash of the source ``data`` and of the assembler itself"""
+    digest = hashlib.sha1()
+    with open(os.path.abspath(__file__), "rb") as f:
+        digest.update(f.read())
+    digest.update(data)
+    return digest.hexdigest()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="DCPU-16 assembler")
     parser.add_argument("-o", default="a.obj", help="Place the output into FILE", metavar="FILE")
+    parser.add_argument("-s", "--symbols", help="Write the address of every label to FILE", metavar="FILE")
+    parser.add_argument("--cache", help="Keep assembled files in DIR, reusing them for unchanged sources", metavar="DIR")
     parser.add_argument("input", help="File with DCPU assembly code")
     args = parser.parse_args()
 
-    program = []
-    labels = {}
+    with open(args.input, "rb") as f:
+        data = f.read()
+    if args.cache is not None:
+        cached = os.path.join(args.cache, cache_key(data))
+        if os.path.exists(cached + ".obj"):
+            shutil.copyfile(cached + ".obj", args.o)
+            if args.symbols is not None:
+                shutil.copyfile(cached + ".sym", args.symbols)
+            raise SystemExit
 
-    for lineno, line in enumerate(open(args.input), start=1):
-        if lineno == 1:
-            line = line.lstrip(codecs.BOM_UTF8)
-
-        mo = line_regex.match(line)
-        if mo is None:
-            report_error(args.input, lineno, "Syntax error: '%s'" % line.strip())
-            break
-
-        token_dict = mo.groupdict()
-        if token_dict is None:
-            report_error(args.input, lineno, "Syntax error: '%s'" % line.strip())
-            break
-
-        if token_dict["label"] is not None:
-            labels[token_dict["label"]] = len(program)
-
-        o = x = y = None
-        if token_dict["basic"] is not None:
-            o = OPCODES[token_dict["basic"].upper()]
-            a, x = handle(token_dict, "op1_")
-            b, y = handle(token_dict, "op2_")
-        elif token_dict["nonbasic"] is not None:
-            o, a = 0x00, 0x01
-            b, y = handle(token_dict, "op3_")
-        elif token_dict["data"] is not None:
-            for datum in re.findall("""("[^"]*"|0x[0-9A-Fa-f]{1,4}|\d+)""", token_dict["data"]):
-                if datum.startswith("\""):
-                    program.extend(ord(ch) for ch in datum[1:-1])
-                elif datum.startswith("0x"):
-                    program.append(int(datum[2:], 16))
-                else:
-                    program.append(int(datum))
-
-        if o is not None:
-            program.append(((b << 10) + (a << 4) + o))
-        if x is not None:
-            program.append(x)
-        if y is not None:
-            program.append(y)
-
-    try:
-        with open(args.o, "wb") as f:
-            for word in program:
-                if isinstance(word, str):
-                    word = labels[word]
-                f.write(struct.pack(">H", word))
-    except KeyError:
+    with open(args.o, "wb") as f:
+        emitter = Emitter(f)
+        # labels after a line in error are never defined, so resolving them
+        # would only report more errors
+        resolved = assemble(io.TextIOWrapper(io.BytesIO(data)), emitter, args.input) and emitter.finish(args.input)
+    if not resolved:
         os.remove(args.o)
+        raise SystemExit(1)
+    if args.symbols is not None:
+        write_symbols(args.symbols, emitter.labels)
+    if args.cache is not None:
+        if not os.path.isdir(args.cache):
+            os.makedirs(args.cache)
+        write_symbols(cached + ".sym", emitter.labels)
+        # the object file goes last, marking the entry complete
+        shutil.copyfile(args.o, cached + ".obj")
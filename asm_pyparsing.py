@@ -259,7 +259,7 @@ def process_operand(o, lvalue=False):
     raise invalid_op("this is a bug")
 
 
-def codegen(source, input_filename="<unknown>"):
+def codegen(source, input_filename="<unknown>", symbols=None):
 
     try:
         parsed = full_grammar.parseString(source)
@@ -417,6 +417,8 @@ def codegen(source, input_filename="<unknown>"):
         program.extend(generate(len(program), line))
 
     log.debug("Labels: {0}".format(labels))
+    if symbols is not None:
+        symbols.update(labels)
 
     log.debug("program: {0}".format(program))
 
@@ -450,6 +452,9 @@ def main():
     parser.add_argument(
         'destination', metavar='OUT', type=str, nargs='?',
         help='file path where to store the binary code')
+    parser.add_argument(
+        '-s', '--symbols', metavar='FILE', type=str,
+        help='file path where to write the address of every label')
     args = parser.parse_args()
 
     if not log.handlers:
@@ -459,11 +464,12 @@ def main():
         if not DEBUG:
             handler.setLevel(logging.INFO)
 
+    labels = {}
     if args.source == "-":
-        program = codegen(sys.stdin.read(), "<stdin>")
+        program = codegen(sys.stdin.read(), "<stdin>", labels)
     else:
         with open(args.source) as fd:
-            program = codegen(fd.read(), args.source)
+            program = codegen(fd.read(), args.source, labels)
 
     if program is None:
         log.fatal("No program produced.")
@@ -481,6 +487,10 @@ def main():
     else:
         with open(args.destination, "wb") as fd:
             fd.write(program)
+    if args.symbols:
+        with open(args.symbols, "w") as fd:
+            for label, address in sorted(labels.items(), key=lambda item: item[1]):
+                fd.write("%04x %s\n" % (address, label))
     log.info("Program written to {0} ({1} bytes, hash={2})"
              .format(args.destination, len(program),
                      hex(abs(hash(program)))))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+import dcpu16
+import loader
+
+
+# cycles each image may run for unless told otherwise
+DEFAULT_CYCLES = 1000000
+
+# start of the video memory hashed into the results, as read by TerminalPlugin
+VRAM_ADDRESS = 0x8000
+
+# reason recorded for an image that raised an exception
+STOP_ERROR = "error"
+
+
+def find_images(patterns):
+    """The .bin files in the directories, or matching the globs, given"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(glob.glob(os.path.join(pattern, "*.bin")))
+        else:
+            paths.extend(glob.glob(pattern))
+    return sorted(set(paths))
+
+
+def state_hash(cpu, vram_words):
+    """SHA-1 of the registers and the video memory of ``cpu``"""
+    words = list(cpu.registers) + list(cpu.memory[VRAM_ADDRESS:VRAM_ADDRESS + vram_words])
+    return hashlib.sha1(struct.pack(">%dH" % len(words), *words)).hexdigest()
+
+
+def run_image(path, cycles=DEFAULT_CYCLES, engine="interpreter", vram_words=80 * 24):
+    """
+        Run the object file at ``path`` without plugins for at most ``cycles``
+        cycles
+
+        Returns a dict of the exit reason, cycles and instructions run, wall
+        time, speed in kHz and the state hash of the machine.
+    """
+    start = time.time()
+    cpu = dcpu16.DCPU16(loader.load(path))
+    result = {"file": path}
+    try:
+        run = cpu.run_for(cycles=cycles, engine=engine)
+        result.update(reason=run.reason, instructions=run.instructions)
+    except Exception as e:
+        result.update(reason=STOP_ERROR, instructions=None, error=repr(e))
+    wall = time.time() - start
+    result.update(
+        cycles=cpu.cycle,
+        wall=round(wall, 6),
+        khz=round(cpu.cycle / wall / 1000, 1) if wall else None,
+        hash=state_hash(cpu, vram_words))
+    return result
+
+
+def _run_image(job):
+    path, cycles, engine, vram_words = job
+    return run_image(path, cycles, engine, vram_words)
+
+
+def run_batch(paths, cycles=DEFAULT_CYCLES, engine="interpreter", vram_words=80 * 24, processes=None):
+    """
+        Run the object files in ``paths`` on a pool of ``processes`` worker
+        processes, by default one per CPU
+
+        Workers stay up for the whole batch, so each imports the emulator
+        once however many images it runs. Yields the results of run_image
+        as they complete.
+    """
+    jobs = [(path, cycles, engine, vram_words) for path in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_run_image, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a batch of DCPU-16 binaries, printing a JSON line per binary")
+    parser.add_argument("-c", "--cycles", type=int, default=DEFAULT_CYCLES, help="Stop each binary after running for this many cycles")
+    parser.add_argument("-e", "--engine", choices=dcpu16.ENGINES, default="interpreter", help="Execution engine to use")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--geometry", action="store", default="80x24", help="Terminal geometry given as `width`x`height`, sizing the video memory hashed", metavar="SIZE")
+    parser.add_argument("images", nargs="+", help="Directories of .bin files or globs matching binaries")
+    args = parser.parse_args()
+
+    width, height = map(int, args.geometry.split("x"))
+    for result in run_batch(find_images(args.images), args.cycles, args.engine, width * height, args.jobs):
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
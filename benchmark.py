@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import asm
+import dcpu16
+import disasm
+import loader
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# cycles each emulator workload runs for
+BENCH_CYCLES = 300000
+
+# runs of every workload, of which the fastest is kept
+REPEAT = 3
+
+# lines in the sources generated for the assemblers
+ASM_SIZES = (1000, 10000, 100000)
+
+# most words the generated sources assemble to, the largest ones spreading
+# lines that assemble to nothing between their instructions to fit in memory
+ASM_WORDS = 0xFFFF
+
+# lines of the asm.py front ends' benchmark, parsed without assembling them
+FRONT_END_LINES = 100000
+
+# words disassembled by the disassembler workload
+DISASM_WORDS = 0x10000
+
+# slowdown, as a fraction, beyond which compare reports a regression
+THRESHOLD = 0.05
+
+# synthetic compute kernels, each spinning at crash once done
+KERNELS = {
+    "count": """
+            SET A, 0
+:loop       ADD A, 1
+            IFN A, 0
+                SET PC, loop
+:crash      SET PC, crash
+""",
+    "copy": """
+            SET J, 0
+:outer      SET I, 0x100
+:inner      SUB I, 1
+            SET [0x2000+I], [0x1000+I]
+            IFN I, 0
+                SET PC, inner
+            ADD J, 1
+            IFN J, 0x100
+                SET PC, outer
+:crash      SET PC, crash
+""",
+    "arith": """
+            SET A, 1
+            SET I, 0
+:loop       MUL A, 3
+            ADD A, O
+            SET B, A
+            DIV B, 7
+            MOD A, 0x3FF
+            SHL B, 2
+            XOR A, B
+            ADD I, 1
+            IFN I, 0
+                SET PC, loop
+:crash      SET PC, crash
+""",
+    "calls": """
+            SET I, 0
+:loop       SET PUSH, I
+            JSR sub
+            SET I, POP
+            ADD I, 1
+            IFN I, 0
+                SET PC, loop
+:crash      SET PC, crash
+:sub        SET A, PEEK
+            AND A, 0xFF
+            BOR A, 0x100
+            SET PC, POP
+""",
+}
+
+# instructions cycled through by the generated assembler sources
+ASM_LINES = [
+    ":l{0} SET A, 0x30",
+    "    SET [0x1000], 0x20",
+    "    SUB A, [0x1000]",
+    "    ADD [0x1000+I], 5",
+    "    IFN A, 0x10",
+    "    SET PC, l{0}",
+    "    JSR l{0}",
+    "    SET PUSH, [A]",
+    "    DAT \"hi\", 0x20 ; data",
+]
+
+# words a cycle through ASM_LINES assembles to
+ASM_CYCLE_WORDS = 18
+
+# lines assembling to nothing, cycled through between the instructions
+ASM_FILLER = [
+    ":f{0}",
+    "    ; {0}",
+]
+
+
+def best_of(func, repeat=REPEAT):
+    """The shortest time ``func`` takes over ``repeat`` runs"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def assemble(source, assembler="asm.py"):
+    """
+        Assemble ``source`` with ``assembler`` in a subprocess
+
+        Returns the seconds taken and the words produced, or None and the
+        error output if the assembler failed.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "source.dasm16")
+        output = os.path.join(directory, "source.obj")
+        with open(path, "w") as f:
+            f.write(source)
+        if assembler == "asm.py":
+            command = [sys.executable, os.path.join(ROOT, assembler), "-o", output, path]
+        else:
+            command = [sys.executable, os.path.join(ROOT, assembler), path, output]
+        start = time.time()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        elapsed = time.time() - start
+        if process.returncode or not os.path.exists(output):
+            return None, err.decode("utf-8", "replace").strip()
+        return elapsed, loader.load(output)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def generate_source(lines, words=ASM_WORDS):
+    """
+        Assembly source of ``lines`` lines cycling through ASM_LINES, with
+        ASM_FILLER lines spread between them if it would otherwise assemble
+        to more than ``words`` words, or None for no limit
+    """
+    instructions = lines
+    if words is not None:
+        instructions = min(lines, words // ASM_CYCLE_WORDS * len(ASM_LINES))
+    source = []
+    i = 0
+    for n in range(lines):
+        if (n + 1) * instructions // lines > i:
+            source.append(ASM_LINES[i % len(ASM_LINES)].format(i // len(ASM_LINES)))
+            i += 1
+        else:
+            source.append(ASM_FILLER[n % len(ASM_FILLER)].format(n))
+    return "\n".join(source) + "\n"
+
+
+def bench_asm_front_end(parse, lines):
+    """
+        Lines per second of generated source parsed by ``parse``, one of the
+        front ends of asm.py, in process and without assembling them
+    """
+    source = generate_source(lines, None).splitlines(True)
+
+    def run():
+        for line in source:
+            parse(line)
+    return lines / best_of(run)
+
+
+def bench_emulator(program, engine, cycles=BENCH_CYCLES):
+    """
+        Speed in kHz of ``engine`` running ``program`` for up to ``cycles``
+        cycles, counting those the runs actually took as they may stop past
+        the budget or, halting, well short of it
+    """
+    results = []
+
+    def run():
+        results.append(dcpu16.DCPU16(program, []).run_for(cycles=cycles, engine=engine))
+    elapsed = best_of(run)
+    return results[-1].cycles / elapsed / 1000
+
+
+def bench_disassembler(words=DISASM_WORDS):
+    """Words per second disassembled from a program of generated code"""
+    elapsed, program = assemble(generate_source(words // 2))
+    if elapsed is None:
+        raise RuntimeError(program)
+
+    def run():
+        d = disasm.Disassembler(program, output=io.StringIO())
+        d.run()
+    return len(program) / best_of(run)
+
+
+def run_benchmarks(quick=False, log=sys.stderr):
+    """
+        Run every workload, returning a dict of results keyed by name, each
+        a dict of its ``value`` and ``unit``; higher values are better
+
+        ``quick`` leaves out the largest assembler sources.
+    """
+    results = {}
+
+    def record(name, value, unit):
+        results[name] = {"value": round(value, 1), "unit": unit}
+        print("%-40s %12.1f %s" % (name, value, unit), file=log)
+
+    programs = [(os.path.basename(path), loader.load(path))
+                for path in sorted(glob.glob(os.path.join(ROOT, "test_binaries", "*.bin")))]
+    for name in sorted(KERNELS):
+        elapsed, program = assemble(KERNELS[name])
+        if elapsed is None:
+            print("kernel %s failed to assemble: %s" % (name, program), file=log)
+        else:
+            programs.append((name, program))
+    for engine in dcpu16.ENGINES:
+        for name, program in programs:
+            try:
+                record("emulator/%s/%s" % (engine, name), bench_emulator(program, engine), "kHz")
+            except Exception as e:
+                print("emulator/%s/%s failed: %r" % (engine, name, e), file=log)
+
+    for assembler in ("asm.py", "asm_pyparsing.py"):
+        for lines in ASM_SIZES:
+            if quick and lines > ASM_SIZES[0]:
+                continue
+            source = generate_source(lines)
+            times = []
+            for i in range(REPEAT):
+                elapsed, output = assemble(source, assembler)
+                if elapsed is None:
+                    break
+                times.append(elapsed)
+            if not times:
+                print("%s failed: %s" % (assembler, output.splitlines()[-1] if output else "no output"), file=log)
+                break
+            record("%s/%d-lines" % (assembler, lines), lines / min(times), "lines/s")
+
+    lines = ASM_SIZES[0] if quick else FRONT_END_LINES
+    for parse in (asm.parse_line, asm.parse_line_regex):
+        record("asm.py/%s/%d-lines" % (parse.__name__, lines), bench_asm_front_end(parse, lines), "lines/s")
+
+    record("disasm", bench_disassembler(), "words/s")
+    return results
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """
+        Compare two sets of results from run_benchmarks
+
+        Returns ``(name, old value, new value, change)`` for every workload
+        in both, with the change as a fraction of the old value, and the
+        names of those that got slower by more than ``threshold``.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]["value"], new[name]["value"]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change < -threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the DCPU-16 emulator, assemblers and disassembler")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Run the benchmarks, writing the results as JSON")
+    run_parser.add_argument("-o", help="Place the results into FILE instead of stdout", metavar="FILE")
+    run_parser.add_argument("--quick", action="store_const", const=True, default=False, help="Leave out the larger assembler sources")
+    compare_parser = commands.add_parser("compare", help="Compare two result files, failing on regressions")
+    compare_parser.add_argument("old", help="Results to compare against")
+    compare_parser.add_argument("new", help="Results to check")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD * 100, help="Slowdown in percent reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": run_benchmarks(args.quick),
+        }
+        output = sys.stdout if args.o is None else open(args.o, "w")
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write("\n")
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)["results"]
+        with open(args.new) as f:
+            new = json.load(f)["results"]
+        rows, regressions = compare(old, new, args.threshold / 100)
+        for name, before, after, change in rows:
+            print("%-40s %12.1f %12.1f %+7.1f%%%s" % (name, before, after, change * 100,
+                                                      "  REGRESSION" if name in regressions else ""))
+        for name in sorted(set(old) ^ set(new)):
+            print("%-40s only in %s" % (name, args.old if name in old else args.new))
+        if regressions:
+            print("%d regression(s) beyond %.1f%%" % (len(regressions), args.threshold))
+            raise SystemExit(1)
+    else:
+        parser.print_help()
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 
 import argparse
-import inspect
-import struct
+import bisect
+import collections
+from array import array
 import time
 import emuplugin
 import disasm
+import loader
+import profiler
+import tracer
 
 
 try:
@@ -14,8 +18,93 @@ except NameError:
     raw_input = input
 
 
-# offsets into DCPU16.memory corresponding to addressing mode codes
-SP, PC, O, LIT = 0x1001B, 0x1001C, 0x1001D, 0x1001E
+# offsets into DCPU16.registers corresponding to addressing mode codes
+SP, PC, O, LIT = 0x1B, 0x1C, 0x1D, 0x1E
+
+# execution engines selectable in DCPU16.run
+ENGINES = ("interpreter", "blocks", "table")
+
+# maximum number of instructions translated into one compiled block
+BLOCK_LIMIT = 32
+
+# times a compiled block may be overwritten before the code at its entry
+# address is interpreted instead of compiled again
+BLOCK_REWRITES = 16
+
+# most cycles a single instruction can take
+MAX_INSTRUCTION_CYCLES = 5
+
+# steps between speed reports
+SPEED_INTERVAL = 100000
+
+# nominal clock rate of the DCPU-16 in Hz
+CLOCK_RATE = 100000
+
+# seconds of emulated time between checks of a throttled run
+THROTTLE_SLICE = 0.01
+
+# seconds behind schedule after which a throttled run stops catching up
+THROTTLE_LAG = 0.1
+
+# what runs do on finding the cpu spinning in an idle loop: keep running it,
+# fast-forward through it, sleeping as the cycles it would take pass at the
+# clock rate, or also stop if nothing can ever break the loop
+IDLE_SPIN = "spin"
+IDLE_SLEEP = "sleep"
+IDLE_HALT = "halt"
+IDLE_MODES = (IDLE_SPIN, IDLE_SLEEP, IDLE_HALT)
+
+# most instructions an idle loop may take to come back to the same state
+IDLE_PROBE = 64
+
+# most checks to wait before probing for an idle loop again
+IDLE_BACKOFF = 64
+
+# reasons for a run to stop, see RunResult
+STOP_HALT = "halt"
+STOP_EXIT = "exit"
+STOP_CYCLES = "cycles"
+STOP_INSTRUCTIONS = "instructions"
+STOP_PC = "pc"
+STOP_PREDICATE = "predicate"
+STOP_BREAK = "break"
+
+# base cycle costs of the opcodes in compiled blocks
+BLOCK_CYCLES = {0x01: 1, 0x02: 2, 0x03: 2, 0x04: 2, 0x05: 3, 0x06: 3, 0x07: 2, 0x08: 2, 0x09: 1, 0x0a: 1, 0x0b: 1}
+
+# Python source of the opcodes in compiled blocks: the new value of the
+# destination D is computed into v from b, and if o is set it is written to O
+# after the destination
+BLOCK_OPS = {
+    0x01: ["v = b"],
+    0x02: ["v = D + b", "r[29] = v >> 16", "v &= 0xFFFF"],
+    0x03: ["v = D - b", "r[29] = 0xFFFF if v < 0 else 0", "v &= 0xFFFF"],
+    0x04: ["v = D * b", "o = (v >> 16) & 0xFFFF", "v &= 0xFFFF"],
+    0x05: ["d = D", "v, o = (d // b & 0xFFFF, ((d << 16) // b) & 0xFFFF) if b else (0, 0)"],
+    0x06: ["v = D % b if b else 0"],
+    0x07: ["v = D << b", "o = (v >> 16) & 0xFFFF", "v &= 0xFFFF"],
+    0x08: ["d = D", "v = d >> b", "o = ((d << 16) >> b) & 0xFFFF"],
+    0x09: ["v = D & b"],
+    0x0a: ["v = D | b"],
+    0x0b: ["v = D ^ b"],
+}
+
+BLOCK_CONDITIONS = {
+    0x0c: "D == b",
+    0x0d: "D != b",
+    0x0e: "D > b",
+    0x0f: "(D & b) != 0",
+}
+
+# addresses from REGISTERS upwards refer to DCPU16.registers in read(),
+# write() and the address passed to plugins' memory_changed()
+REGISTERS = 0x10000
+
+# size of the address space covering memory and registers
+ADDRESSES = REGISTERS + 0x20
+
+# words per page of memory shared between snapshots
+PAGE_SIZE = 0x400
 
 
 def opcode(code):
@@ -28,239 +117,1500 @@ def opcode(code):
     return decorator
 
 
+RunResult = collections.namedtuple("RunResult", "reason cycles instructions")
+RunResult.__doc__ = """
+    Outcome of DCPU16.run_until and friends
+
+    ``reason`` is one of STOP_HALT (executed 0x0000), STOP_EXIT (a plugin
+    raised SystemExit), STOP_CYCLES, STOP_INSTRUCTIONS, STOP_PC,
+    STOP_PREDICATE or STOP_BREAK (a breakpoint or watchpoint was hit, see
+    DCPU16.hit). ``cycles`` and ``instructions`` count the cycles consumed
+    and instructions stepped during the run.
+"""
+
+Snapshot = collections.namedtuple("Snapshot", "pages registers skip cycle")
+Snapshot.__doc__ = """
+    State of a DCPU16 captured by DCPU16.snapshot
+
+    ``pages`` holds the memory as immutable strings of PAGE_SIZE words,
+    shared with other snapshots wherever their contents are the same.
+"""
+
+# decode cache entry of an address run_until stops at
+TRAP = (None, None, None, None, None, None, None, 0)
+
+
+Operand = collections.namedtuple("Operand", "words destination value destination_source value_source")
+Operand.__doc__ = """
+    The handlers of an addressing mode, see operand_handlers
+"""
+
+
+def operand_handlers(code):
+    """
+        The handlers of addressing mode ``code``, as an Operand
+
+        ``words`` is the number of next words the operand takes, each of
+        which also costs a cycle. The other handlers are called with the
+        value of the operand's next word, if any, and its address.
+
+        ``destination(cpu, next_word, word)`` decodes the operand as a
+        destination into ``(m, fn, arg)``: at execution time it is
+        ``m[fn(arg)]``, or simply ``m[arg]`` if ``fn`` is None.
+        ``value(cpu, next_word, word)`` decodes it as a value into ``(fn,
+        arg)``, the value being ``fn(arg)``, or ``arg`` if ``fn`` is None.
+
+        For compiled blocks, ``destination_source(next_word, word)``
+        returns the lines of Python source resolving the operand, the store
+        ("m" or "r") and the index expression of the operand, and
+        ``value_source(next_word, word)`` the lines and an expression for
+        its value.
+    """
+    if code < 0x08 or 0x1B <= code <= 0x1D:
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.registers, None, code),
+            lambda cpu, next_word, word: (cpu.registers.__getitem__, code),
+            lambda next_word, word: ([], "r", "%d" % code),
+            lambda next_word, word: ([], "r[%d]" % code))
+    elif code < 0x10:
+        register = code % 0x08
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.memory, cpu.registers.__getitem__, register),
+            lambda cpu, next_word, word: (cpu.operand_indirect_value, register),
+            lambda next_word, word: (["ta = r[%d]" % register], "m", "ta"),
+            lambda next_word, word: ([], "m[r[%d]]" % register))
+    elif code < 0x18:
+        register = code % 0x10
+        return Operand(
+            1,
+            lambda cpu, next_word, word: (cpu.memory, cpu.operand_indexed, (next_word, register)),
+            lambda cpu, next_word, word: (cpu.operand_indexed_value, (next_word, register)),
+            lambda next_word, word: (["ta = (%d + r[%d]) & 0xFFFF" % (next_word, register)], "m", "ta"),
+            lambda next_word, word: ([], "m[(%d + r[%d]) & 0xFFFF]" % (next_word, register)))
+    elif code == 0x18:
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.memory, cpu.operand_pop, None),
+            lambda cpu, next_word, word: (cpu.operand_pop_value, None),
+            lambda next_word, word: (["ta = r[%d]" % SP, "r[%d] = (ta + 1) & 0xFFFF" % SP], "m", "ta"),
+            lambda next_word, word: (["tb = r[%d]" % SP, "r[%d] = (tb + 1) & 0xFFFF" % SP], "m[tb]"))
+    elif code == 0x19:
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.memory, cpu.operand_peek, None),
+            lambda cpu, next_word, word: (cpu.operand_peek_value, None),
+            lambda next_word, word: (["ta = r[%d]" % SP], "m", "ta"),
+            lambda next_word, word: ([], "m[r[%d]]" % SP))
+    elif code == 0x1A:
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.memory, cpu.operand_push, None),
+            lambda cpu, next_word, word: (cpu.operand_push_value, None),
+            lambda next_word, word: (["ta = r[%d] = (r[%d] - 1) & 0xFFFF" % (SP, SP)], "m", "ta"),
+            lambda next_word, word: (["tb = r[%d] = (r[%d] - 1) & 0xFFFF" % (SP, SP)], "m[tb]"))
+    elif code == 0x1E:
+        return Operand(
+            1,
+            lambda cpu, next_word, word: (cpu.memory, None, next_word),
+            lambda cpu, next_word, word: (cpu.memory.__getitem__, next_word),
+            lambda next_word, word: ([], "m", "%d" % next_word),
+            lambda next_word, word: ([], "m[%d]" % next_word))
+    elif code == 0x1F:
+        # as a destination this is the next word itself
+        return Operand(
+            1,
+            lambda cpu, next_word, word: (cpu.memory, None, word),
+            lambda cpu, next_word, word: (None, next_word),
+            lambda next_word, word: ([], "m", "%d" % word),
+            lambda next_word, word: ([], "%d" % next_word))
+    else:
+        literal = code % 0x20
+        return Operand(
+            0,
+            lambda cpu, next_word, word: (cpu.registers, cpu.operand_literal, literal),
+            lambda cpu, next_word, word: (None, literal),
+            lambda next_word, word: (["r[%d] = %d" % (LIT, literal)], "r", "%d" % LIT),
+            lambda next_word, word: ([], "%d" % literal))
+
+
+# the handlers of every addressing mode indexed by its code
+OPERANDS = tuple(operand_handlers(code) for code in range(0x40))
+
+
+class Throttle:
+    """
+        Paces a run to ``clock`` cycles per second, sleeping whenever it
+        gets ahead of the wall clock
+
+        ``drift`` is how far behind schedule, in seconds, the run was at
+        the last check (negative when ahead) and ``max_drift`` the furthest
+        behind it fell. ``missed`` counts the deadlines missed by more than
+        THROTTLE_LAG, after which the schedule restarts from the current
+        time rather than running flat out to catch up. ``slept`` totals
+        the seconds spent sleeping.
+    """
+
+    def __init__(self, clock, cycle):
+        self.clock = clock
+        # cycles between checks
+        self.interval = max(int(clock * THROTTLE_SLICE), 1)
+        self.start_time = time.time()
+        self.start_cycle = cycle
+        self.drift = self.max_drift = self.slept = 0.0
+        self.missed = 0
+
+    def check(self, cycle):
+        now = time.time()
+        self.drift = drift = now - self.start_time - (cycle - self.start_cycle) / float(self.clock)
+        self.max_drift = max(self.max_drift, drift)
+        if drift < 0:
+            time.sleep(-drift)
+            self.slept -= drift
+        elif drift > THROTTLE_LAG:
+            self.missed += 1
+            self.start_time = now
+            self.start_cycle = cycle
+
+
+class Budget:
+    """
+        Limits of a run, checked by the execution engines once they reach
+        the step count returned by the previous check
+    """
+
+    def __init__(self, cpu, cycles, instructions, predicate, show_speed, periodic=True, throttle=None, idle=None,
+                 recorder=None):
+        self.cpu = cpu
+        self.start = cpu.instructions
+        self.cycle_limit = None if cycles is None else cpu.cycle + cycles
+        self.instructions = instructions
+        self.predicate = predicate
+        self.show_speed = show_speed
+        self.report = SPEED_INTERVAL
+        self.last_time = time.time()
+        self.last_cycle = cpu.cycle
+        self.throttle = throttle
+        # plugins with a tick_interval and the step count they are next due
+        # at, carried over between runs in cpu.tick_due; a schedule more than
+        # an interval ahead, as after going back in time, starts over
+        self.ticks = []
+        if periodic:
+            for p in cpu.periodic:
+                due = cpu.tick_due[p] = min(cpu.tick_due.get(p, cpu.instructions + p.tick_interval),
+                                            cpu.instructions + p.tick_interval)
+                self.ticks.append([due - self.start, p])
+
+        self.idle = None if idle == IDLE_SPIN else idle
+        # recorder of the run, passed the steps of idle loop probes
+        self.recorder = recorder
+        # steps probed or fast-forwarded through in idle loops, which the
+        # engines do not count
+        self.skipped = 0
+        # registers other than PC and the plugin write count at the last
+        # check, and the checks to wait before probing for an idle loop
+        self.idle_state = None
+        self.idle_wait = 0
+        self.idle_backoff = 1
+
+    def check(self, steps):
+        """
+            Return the reason to stop after ``steps`` steps, or None and the
+            step count at which to check again
+        """
+        steps += self.skipped
+        reason, check = self.limits(steps)
+        if reason is None and self.idle is not None and not self.cpu.tickers:
+            skipped = self.skipped
+            period = self.idle_period(check - steps)
+            steps += self.skipped - skipped
+            if period is not None:
+                reason, check = self.fast_forward(steps, *period)
+            elif steps >= check:
+                # the probe used up the steps to the next check
+                reason, check = self.limits(steps)
+        if check is not None:
+            check -= self.skipped
+        return reason, check
+
+    def idle_period(self, limit):
+        """
+            Probe for the cpu spinning in an idle loop once the registers
+            other than PC have stayed the same between checks, without
+            writes from plugins, in at most ``limit`` steps
+
+            Returns the steps and cycles of one turn of the loop, which the
+            probe has just run, or None. The steps of failed probes are
+            counted all the same.
+        """
+        cpu = self.cpu
+        registers = cpu.registers
+        state = (registers[:PC].tobytes(), registers[PC + 1:].tobytes(), cpu.writes)
+        if state != self.idle_state:
+            self.idle_state = state
+            self.idle_wait = 0
+            self.idle_backoff = 1
+            return None
+        if self.idle_wait > 0:
+            self.idle_wait -= 1
+            return None
+
+        idle, steps, cycles = cpu.probe_idle_loop(min(limit, IDLE_PROBE), self.recorder)
+        self.skipped += steps
+        if not idle:
+            self.idle_backoff = min(self.idle_backoff * 2, IDLE_BACKOFF)
+            self.idle_wait = self.idle_backoff
+            return None
+        return steps, cycles
+
+    def fast_forward(self, steps, period_steps, period_cycles):
+        """
+            Advance the cycle count through turns of an idle loop until a
+            limit is reached or a plugin writes to the cpu, sleeping as long
+            as the turns would take at the clock rate
+
+            Returns the reason to stop, or None and the step count at which
+            to check again.
+        """
+        cpu = self.cpu
+        if self.idle == IDLE_HALT and not cpu.periodic:
+            # nothing can ever write to the cpu
+            return STOP_HALT, None
+
+        writes = cpu.writes
+        reason, check = self.limits(steps)
+        while reason is None and cpu.writes == writes:
+            turns = max((check - steps) // period_steps, 1)
+            if self.cycle_limit is not None:
+                turns = min(turns, max(-(-(self.cycle_limit - cpu.cycle) // period_cycles), 1))
+            steps += turns * period_steps
+            self.skipped += turns * period_steps
+            cpu.cycle += turns * period_cycles
+            if self.throttle is None:
+                time.sleep(turns * period_cycles / float(CLOCK_RATE))
+            reason, check = self.limits(steps)
+        return reason, check
+
+    def limits(self, steps):
+        """
+            Check the limits of the run, tick the plugins due and report the
+            speed, counting the steps fast-forwarded through idle loops
+        """
+        cpu = self.cpu
+        cpu.instructions = self.start + steps
+        if steps >= self.report:
+            if self.show_speed:
+                throttle = self.throttle
+                if throttle is None:
+                    print("%dkHz" % (int((cpu.cycle - self.last_cycle) / (time.time() - self.last_time)) / 1000))
+                else:
+                    print("%dkHz (drift %.1fms, %d missed)" % (
+                        int((cpu.cycle - self.last_cycle) / (time.time() - self.last_time)) / 1000,
+                        throttle.drift * 1000, throttle.missed))
+            self.last_time = time.time()
+            self.last_cycle = cpu.cycle
+            self.report = steps + SPEED_INTERVAL
+
+        n = self.report - steps
+        for due in self.ticks:
+            if steps >= due[0]:
+                try:
+                    due[1].tick(cpu)
+                except SystemExit:
+                    return STOP_EXIT, None
+                due[0] = steps + due[1].tick_interval
+                cpu.tick_due[due[1]] = self.start + due[0]
+            n = min(n, due[0] - steps)
+        if self.instructions is not None:
+            if steps >= self.instructions:
+                return STOP_INSTRUCTIONS, None
+            n = min(n, self.instructions - steps)
+        if self.cycle_limit is not None:
+            if cpu.cycle >= self.cycle_limit:
+                return STOP_CYCLES, None
+            # no instruction can get past the limit before the next check
+            n = min(n, (self.cycle_limit - cpu.cycle) // MAX_INSTRUCTION_CYCLES)
+        if self.predicate is not None:
+            if self.predicate(cpu):
+                return STOP_PREDICATE, None
+            n = min(n, BLOCK_LIMIT)
+        if self.throttle is not None:
+            self.throttle.check(cpu.cycle)
+            # instructions take at least a cycle, other than skipped ones
+            n = min(n, self.throttle.interval)
+        return None, steps + max(n, 1)
+
+
+class BlockSource:
+    """
+        Python source of a block being compiled by DCPU16.compile_block
+
+        With plugins to tick after every instruction, PC, the cycle count
+        and the instruction count are brought up to date and the plugins
+        ticked after every instruction, as the interpreter does. Writes are
+        reported to plugins for the addresses marked in ``watched``.
+    """
+
+    def __init__(self, entry, memory, tickers, watched):
+        self.entry = entry
+        self.memory = memory
+        self.ticking = bool(tickers)
+        self.watched = watched
+        self.watching_memory = any(watched[:REGISTERS])
+        self.lines = []
+        self.indent = 2
+        # cycles not yet added to cpu.cycle
+        self.cycles = 0
+        # addresses of the words the block was compiled from
+        self.addresses = []
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def text(self):
+        return "\n".join(["def make(cpu, m, r, code, plugins, blocks, watched):", "    def block():"] + self.lines + ["    return block", ""])
+
+    def word(self, address):
+        """Return the next word at ``address`` and the address following it"""
+        self.addresses.append(address)
+        return self.memory[address], (address + 1) % 0x10000
+
+    def destination(self, a, address):
+        """
+            Emit code resolving operand ``a`` as a destination
+
+            Returns the store ("m" or "r") and index expression of the operand
+            and the address following any next word it takes.
+        """
+        operand = OPERANDS[a]
+        next_word, following = self.word(address) if operand.words else (None, address)
+        lines, store, index = operand.destination_source(next_word, address)
+        for line in lines:
+            self.emit(line)
+        return store, index, following
+
+    def value(self, b, address):
+        """
+            Emit code resolving operand ``b`` as a value
+
+            Returns an expression for the value and the address following any
+            next word it takes.
+        """
+        if b == PC:
+            # PC has been advanced past the instruction by now
+            return "%d" % address, address
+        operand = OPERANDS[b]
+        next_word, following = self.word(address) if operand.words else (None, address)
+        lines, value = operand.value_source(next_word, address)
+        for line in lines:
+            self.emit(line)
+        return value, following
+
+    def instruction(self, address, opcode, a, b, count):
+        """
+            Emit the ``count``th instruction of the block, found at ``address``
+
+            Returns the address of the next instruction, or None if this one
+            ends the block. IFx instructions leave their outcome in ``s`` for
+            conditional() to act on.
+        """
+        pc = address
+        _, address = self.word(address)
+
+        if opcode == 0x00:
+            value, address = self.value(b, address)
+            self.cycles += 2 + (address - pc - 1) % 0x10000
+            self.emit("b = " + value)
+            self.emit("sp = r[%d] = (r[%d] - 1) & 0xFFFF" % (SP, SP))
+            self.emit("m[sp] = %d" % address)
+            self.emit("if code[sp]:")
+            self.emit("    cpu.invalidate(sp)")
+            self.emit("r[%d] = b" % PC)
+            self.exit(None, count, tick=True)
+            return None
+
+        store, index, address = self.destination(a, address)
+        value, address = self.value(b, address)
+        self.cycles += (address - pc - 1) % 0x10000
+        self.emit("b = " + value)
+        target = "%s[%s]" % (store, index)
+        branch = store == "r" and index == "%d" % PC
+        if store == "r":
+            changed = "%d" % (REGISTERS + int(index))
+            notify = self.watched[REGISTERS + int(index)]
+        elif index.isdigit():
+            changed = index
+            notify = self.watched[int(index)]
+        else:
+            changed = None
+            notify = self.watching_memory
+        if branch and (opcode != 0x01 or notify):
+            self.emit("r[%d] = %d" % (PC, address))
+
+        if opcode >= 0x0c:
+            self.emit("s = " + BLOCK_CONDITIONS[opcode].replace("D", target))
+            self.emit("if not s:")
+            self.emit("    cpu.cycle += 3")
+            return address
+
+        if notify:
+            self.emit("old = " + target)
+        for line in BLOCK_OPS[opcode]:
+            self.emit(line.replace("D", target))
+        self.emit(target + " = v")
+        if opcode in (0x04, 0x05, 0x07, 0x08):
+            self.emit("r[%d] = o" % O)
+            if target == "r[%d]" % O:
+                self.emit("v = o")
+        self.cycles += BLOCK_CYCLES[opcode]
+
+        if notify:
+            if changed is None:
+                self.emit("if old != v and watched[%s] and cpu.notify_write(%s, v, old):" % (index, index))
+            else:
+                self.emit("if old != v and cpu.notify_write(%s, v, old):" % changed)
+            # a watchpoint was hit: stop the run before the next instruction
+            self.indent += 1
+            if store == "m":
+                self.emit("if code[%s]:" % index)
+                self.emit("    cpu.invalidate(%s)" % index)
+            if branch:
+                self.emit("cpu.trap(r[%d])" % PC)
+                self.exit(None, count, tick=True)
+            else:
+                self.emit("cpu.trap(%d)" % address)
+                self.exit(address, count, tick=True)
+            self.indent -= 1
+        if store == "m":
+            self.emit("if code[%s]:" % index)
+            self.emit("    cpu.invalidate(%s)" % index)
+            if not self.ticking:
+                # stop if the block itself was overwritten
+                self.emit("    if blocks.get(%d) is not block:" % self.entry)
+                self.indent += 2
+                self.exit(address, count)
+                self.indent -= 2
+
+        if branch:
+            self.exit(None, count, tick=True)
+            return None
+        if self.ticking:
+            self.emit("r[%d] = %d" % (PC, address))
+            self.flush()
+            self.tick()
+            self.emit("if r[%d] != %d or blocks.get(%d) is not block:" % (PC, address, self.entry))
+            self.emit("    return %d" % count)
+        return address
+
+    def conditional(self, address, count, trap=False):
+        """
+            End the block after the IFx instruction preceding ``address``
+
+            The instruction at ``address`` is emitted under the IFx's outcome
+            where possible, otherwise it is left to the caller to skip.
+        """
+        w = self.memory[address]
+        operands, opcode = divmod(w, 16)
+        b, a = divmod(operands, 64)
+        if self.ticking or trap or 0x0c <= opcode <= 0x0f or (opcode == 0x00 and a != 0x01):
+            self.emit("cpu.skip = not s")
+            self.exit(address, count, tick=True)
+            return
+
+        cycles = self.cycles
+        self.emit("if s:")
+        self.indent += 1
+        end = self.instruction(address, opcode, a, b, count + 1)
+        if end is not None:
+            self.exit(end, count + 1)
+        self.indent -= 1
+        self.cycles = cycles
+
+        # a skipped instruction still has its next words
+        length = 1
+        for operand in (a, b) if opcode else (b,):
+            if 0x10 <= operand < 0x18 or operand in (0x1E, 0x1F):
+                length += 1
+        self.exit((address + length) % 0x10000, count + 1)
+
+    def flush(self):
+        if self.cycles:
+            self.emit("cpu.cycle += %d" % self.cycles)
+            self.cycles = 0
+
+    def tick(self):
+        self.emit("cpu.instructions += 1")
+        self.emit("for p in plugins:")
+        self.emit("    p.tick(cpu)")
+
+    def exit(self, address, count, tick=False):
+        """
+            Emit a return from the block with PC set to ``address``, unless
+            None, after ``count`` instructions
+        """
+        if address is not None:
+            self.emit("r[%d] = %d" % (PC, address))
+        if self.cycles:
+            self.emit("cpu.cycle += %d" % self.cycles)
+        if tick and self.ticking:
+            self.tick()
+        self.emit("return %d" % count)
+
+
 class DCPU16:
 
     def __init__(self, memory, plugins=[]):
 
         self.plugins = plugins
 
-        self.memory = [memory[i] if i < len(memory) else 0 for i in range(0x1001F)]
+        if isinstance(memory, array) and memory.typecode == "H":
+            program = memory[:0x10000]
+        else:
+            program = array("H", memory[:0x10000])
+        self.memory = array("H", [0]) * 0x10000
+        self.memory[:len(program)] = program
+
+        # A, B, C, X, Y, Z, I, J followed by SP, PC, O and LIT at the
+        # offsets of their addressing mode codes
+        self.registers = array("H", [0]) * 0x20
 
         self.skip = False
         self.cycle = 0
 
-        self.opcodes = {}
-        for name, value in inspect.getmembers(self):
-            if inspect.ismethod(value) and getattr(value, "_is_opcode", False):
-                self.opcodes[getattr(value, "_opcode")] = value
+        # instructions stepped over all runs, brought up to date at every
+        # budget check, after every instruction while plugins are ticked at
+        # each, and at the end of runs
+        self.instructions = 0
+
+        # list to append (instructions, address, value) to for every write
+        # through write(), or None
+        self.journal = None
+
+        # decoded instructions keyed by the address of their first word,
+        # held in dicts as programs only ever run a small part of memory
+        self.decode_cache = {}
+
+        # compiled blocks keyed by entry address, the entry addresses of the
+        # blocks covering each code address and the addresses covered by
+        # each block, and which plugin hooks the blocks were compiled for
+        self.block_cache = {}
+        self.block_index = {}
+        self.block_addresses = {}
+        self.block_plugins = None
+
+        # times the blocks at each entry address were overwritten
+        self.block_rewrites = {}
+
+        # non-zero for addresses covered by a decoded instruction or block
+        self.code = bytearray(ADDRESSES)
+
+        # addresses run_until stops at
+        self.traps = set()
+
+        # conditions, or None to stop unconditionally, keyed by the addresses
+        # runs stop at and the addresses, REGISTERS + register for
+        # registers, whose changes stop runs after the instruction making them
+        self.breakpoints = {}
+        self.watchpoints = {}
+
+        # the breakpoint or watchpoint address the last run stopped for
+        self.hit = None
+
+        # the snapshot taken or restored last, whose pages later ones share
+        self.last_snapshot = None
+
+        # Throttle pacing the last run with a clock rate
+        self.throttle = None
+
+        # writes through write() and restore(), which are how plugins
+        # rather than the program change the cpu
+        self.writes = 0
+
+        # the instruction count at which each plugin with a tick_interval
+        # is next ticked, kept across runs
+        self.tick_due = {}
+
+        # looked up by name so that subclasses may override opcodes
+        self.opcodes = dict((code, getattr(self, func.__name__)) for code, func in OPCODES.items())
+
+        # dense opcode tables of the table engine
+        self.basic_opcodes = [self.opcodes.get(opcode) for opcode in range(0x10)]
+        self.nonbasic_opcodes = [self.opcodes.get(a << 4) for a in range(0x40)]
+
+        self.index_plugins()
+
+    def index_plugins(self):
+        """
+            Sort self.plugins by the hooks they implement
+
+            Plugins are ticked after every instruction, or every
+            tick_interval instructions if it is larger, and are only told
+            about writes within their memory_ranges.
+        """
+        self.tickers = []
+        self.periodic = []
+        ranges = []
+        for p in self.plugins:
+            if emuplugin.implements(p, "tick"):
+                if getattr(p, "tick_interval", 1) > 1:
+                    self.periodic.append(p)
+                else:
+                    self.tickers.append(p)
+            if emuplugin.implements(p, "memory_changed"):
+                for first, last in getattr(p, "memory_ranges", None) or [(0, ADDRESSES - 1)]:
+                    ranges.append((first, min(last, ADDRESSES - 1), p))
+
+        # non-zero for addresses some plugin or watchpoint is told about
+        # writes to
+        self.watched = bytearray(ADDRESSES)
+        for first, last, p in ranges:
+            self.watched[first:last + 1] = b"\x01" * (last + 1 - first)
+        for address in self.watchpoints:
+            self.watched[address] = 1
+        # the watched registers instructions also change without naming
+        # them as their destination, compared around every instruction
+        self.implicit_watches = tuple(r for r in (SP, O) if REGISTERS + r in self.watchpoints)
+
+        # the plugins interested in each interval between successive bounds
+        self.watch_bounds = sorted(set([0] + [first for first, last, p in ranges] + [last + 1 for first, last, p in ranges]))
+        self.watch_plugins = []
+        for bound in self.watch_bounds:
+            self.watch_plugins.append(tuple(p for p in self.plugins if any(
+                first <= bound <= last for first, last, q in ranges if q is p)))
+
+        self.plugin_signature = (tuple(map(id, self.tickers)), tuple(self.watch_bounds),
+                                 tuple(tuple(map(id, w)) for w in self.watch_plugins),
+                                 tuple(sorted(self.watchpoints)))
+
+    def notify_write(self, address, value, oldvalue):
+        """
+            Tell the plugins watching ``address`` about a write to it
+
+            Returns True if a watchpoint there is hit, recording it in
+            ``self.hit``.
+        """
+        for p in self.watch_plugins[bisect.bisect_right(self.watch_bounds, address) - 1]:
+            p.memory_changed(self, address, value, oldvalue)
+        return self.check_watchpoint(address)
+
+    def check_watchpoint(self, address):
+        """
+            Return True if a watchpoint at ``address``, just changed, is
+            hit, recording it in ``self.hit``
+        """
+        if address in self.watchpoints:
+            condition = self.watchpoints[address]
+            if condition is None or condition(self):
+                self.hit = address
+                return True
+        return False
+
+    def trap(self, address):
+        """Make the current run stop at ``address``"""
+        self.traps.add(address)
+        self.invalidate(address)
+
+    def read(self, address):
+        """Read a word of memory, or a register if address >= REGISTERS"""
+        if address < REGISTERS:
+            return self.memory[address]
+        return self.registers[address - REGISTERS]
+
+    def write(self, address, value):
+        """Write a word of memory, or a register if address >= REGISTERS"""
+        self.writes += 1
+        if self.journal is not None:
+            self.journal.append((self.instructions, address, value))
+        if address < REGISTERS:
+            self.memory[address] = value
+            self.invalidate(address)
+        else:
+            self.registers[address - REGISTERS] = value
+
+    # Opcodes write to m[a], where m is either self.memory or self.registers
 
     @opcode(0x01)
-    def SET(self, a, b):
-        self.memory[a] = b
+    def SET(self, m, a, b):
+        m[a] = b
         self.cycle += 1
 
     @opcode(0x02)
-    def ADD(self, a, b):
-        o, r = divmod(self.memory[a] + b, 0x10000)
-        self.memory[O] = o
-        self.memory[a] = r
+    def ADD(self, m, a, b):
+        o, r = divmod(m[a] + b, 0x10000)
+        self.registers[O] = o
+        m[a] = r
         self.cycle += 2
 
     @opcode(0x03)
-    def SUB(self, a, b):
-        o, r = divmod(self.memory[a] - b, 0x10000)
-        self.memory[O] = 0xFFFF if o == -1 else 0x0000
-        self.memory[a] = r
+    def SUB(self, m, a, b):
+        o, r = divmod(m[a] - b, 0x10000)
+        self.registers[O] = 0xFFFF if o == -1 else 0x0000
+        m[a] = r
         self.cycle += 2
 
     @opcode(0x04)
-    def MUL(self, a, b):
-        o, r = divmod(self.memory[a] * b, 0x10000)
-        self.memory[a] = r
-        self.memory[O] = o % 0x10000
+    def MUL(self, m, a, b):
+        o, r = divmod(m[a] * b, 0x10000)
+        m[a] = r
+        self.registers[O] = o % 0x10000
         self.cycle += 2
 
     @opcode(0x05)
-    def DIV(self, a, b):
+    def DIV(self, m, a, b):
         if b == 0x0:
             r = 0x0
             o = 0x0
         else:
-            r = self.memory[a] / b % 0x10000
-            o = ((self.memory[a] << 16) / b) % 0x10000
-        self.memory[a] = r
-        self.memory[O] = o
+            r = m[a] // b % 0x10000
+            o = ((m[a] << 16) // b) % 0x10000
+        m[a] = r
+        self.registers[O] = o
         self.cycle += 3
 
     @opcode(0x06)
-    def MOD(self, a, b):
+    def MOD(self, m, a, b):
         if b == 0x0:
             r = 0x0
         else:
-            r = self.memory[a] % b
-        self.memory[a] = r
+            r = m[a] % b
+        m[a] = r
         self.cycle += 3
 
     @opcode(0x07)
-    def SHL(self, a, b):
-        o, r = divmod(self.memory[a] << b, 0x10000)
-        self.memory[a] = r
-        self.memory[O] = o % 0x10000
+    def SHL(self, m, a, b):
+        o, r = divmod(m[a] << b, 0x10000)
+        m[a] = r
+        self.registers[O] = o % 0x10000
         self.cycle += 2
 
     @opcode(0x08)
-    def SHR(self, a, b):
-        r = self.memory[a] >> b
-        o = ((self.memory[a] << 16) >> b) % 0x10000
-        self.memory[a] = r
-        self.memory[O] = o
+    def SHR(self, m, a, b):
+        r = m[a] >> b
+        o = ((m[a] << 16) >> b) % 0x10000
+        m[a] = r
+        self.registers[O] = o
         self.cycle += 2
 
     @opcode(0x09)
-    def AND(self, a, b):
-        self.memory[a] = self.memory[a] & b
+    def AND(self, m, a, b):
+        m[a] = m[a] & b
         self.cycle += 1
 
     @opcode(0x0a)
-    def BOR(self, a, b):
-        self.memory[a] = self.memory[a] | b
+    def BOR(self, m, a, b):
+        m[a] = m[a] | b
         self.cycle += 1
 
     @opcode(0x0b)
-    def XOR(self, a, b):
-        self.memory[a] = self.memory[a] ^ b
+    def XOR(self, m, a, b):
+        m[a] = m[a] ^ b
         self.cycle += 1
 
     @opcode(0x0c)
-    def IFE(self, a, b):
-        self.skip = not (self.memory[a] == b)
+    def IFE(self, m, a, b):
+        self.skip = not (m[a] == b)
         self.cycle += 2 + 1 if self.skip else 0
 
     @opcode(0x0d)
-    def IFN(self, a, b):
-        self.skip = not (self.memory[a] != b)
+    def IFN(self, m, a, b):
+        self.skip = not (m[a] != b)
         self.cycle += 2 + 1 if self.skip else 0
 
     @opcode(0x0e)
-    def IFG(self, a, b):
-        self.skip = not (self.memory[a] > b)
+    def IFG(self, m, a, b):
+        self.skip = not (m[a] > b)
         self.cycle += 2 + 1 if self.skip else 0
 
     @opcode(0x0f)
-    def IFB(self, a, b):
-        self.skip = not ((self.memory[a] & b) != 0)
+    def IFB(self, m, a, b):
+        self.skip = not ((m[a] & b) != 0)
         self.cycle += 2 + 1 if self.skip else 0
 
     @opcode(0x010)
-    def JSR(self, a, b):
-        self.memory[SP] = (self.memory[SP] - 1) % 0x10000
-        pc = self.memory[PC]
-        self.memory[self.memory[SP]] = pc
-        self.memory[PC] = b
+    def JSR(self, m, a, b):
+        registers = self.registers
+        sp = registers[SP] = (registers[SP] - 1) % 0x10000
+        self.memory[sp] = registers[PC]
+        if self.code[sp]:
+            self.invalidate(sp)
+        registers[PC] = b
         self.cycle += 2
 
-    def get_operand(self, a, dereference=False):
-        literal = False
-        if a < 0x08 or 0x1B <= a <= 0x1D:
-            arg1 = 0x10000 + a
-        elif a < 0x10:
-            arg1 = self.memory[0x10000 + (a % 0x08)]
-        elif a < 0x18:
-            next_word = self.memory[self.memory[PC]]
-            self.memory[PC] += 1
-            arg1 = next_word + self.memory[0x10000 + (a % 0x10)]
-            self.cycle += 0 if self.skip else 1
-        elif a == 0x18:
-            arg1 = self.memory[SP]
-            if not self.skip:
-                self.memory[SP] = (self.memory[SP] + 1) % 0x10000
-        elif a == 0x19:
-            arg1 = self.memory[SP]
-        elif a == 0x1A:
-            if not self.skip:
-                self.memory[SP] = (self.memory[SP] - 1) % 0x10000
-            arg1 = self.memory[SP]
-        elif a == 0x1E:
-            arg1 = self.memory[self.memory[PC]]
-            self.memory[PC] += 1
-            self.cycle += 0 if self.skip else 1
-        elif a == 0x1F:
-            arg1 = self.memory[PC]
-            self.memory[PC] += 1
-            self.cycle += 0 if self.skip else 1
+    def invalidate(self, address):
+        """Drop decoded instructions and compiled blocks covering ``address``"""
+        # an instruction is at most three words long
+        cache = self.decode_cache
+        cache.pop(address, None)
+        cache.pop((address - 1) % 0x10000, None)
+        cache.pop((address - 2) % 0x10000, None)
+        for entry in self.block_index.pop(address, ()):
+            self.drop_block(entry)
+        self.code[address] = 0
+
+    def drop_block(self, entry):
+        """Drop the compiled block at ``entry`` from the cache and index"""
+        self.block_cache.pop(entry, None)
+        self.block_rewrites[entry] = self.block_rewrites.get(entry, 0) + 1
+        index = self.block_index
+        for address in self.block_addresses.pop(entry, ()):
+            entries = index.get(address)
+            if entries is not None:
+                entries.remove(entry)
+                if not entries:
+                    del index[address]
+
+    def clear_blocks(self):
+        """Drop all compiled blocks"""
+        self.block_cache = {}
+        self.block_index = {}
+        self.block_addresses = {}
+        self.block_rewrites = {}
+
+    def operand_indirect_value(self, register):
+        return self.memory[self.registers[register]]
+
+    def operand_indexed(self, arg):
+        next_word, register = arg
+        return (next_word + self.registers[register]) % 0x10000
+
+    def operand_indexed_value(self, arg):
+        next_word, register = arg
+        return self.memory[(next_word + self.registers[register]) % 0x10000]
+
+    def operand_pop(self, arg):
+        registers = self.registers
+        sp = registers[SP]
+        registers[SP] = (sp + 1) % 0x10000
+        return sp
+
+    def operand_pop_value(self, arg):
+        registers = self.registers
+        sp = registers[SP]
+        registers[SP] = (sp + 1) % 0x10000
+        return self.memory[sp]
+
+    def operand_peek(self, arg):
+        return self.registers[SP]
+
+    def operand_peek_value(self, arg):
+        return self.memory[self.registers[SP]]
+
+    def operand_push(self, arg):
+        registers = self.registers
+        sp = registers[SP] = (registers[SP] - 1) % 0x10000
+        return sp
+
+    def operand_push_value(self, arg):
+        registers = self.registers
+        sp = registers[SP] = (registers[SP] - 1) % 0x10000
+        return self.memory[sp]
+
+    def operand_literal(self, value):
+        self.registers[LIT] = value
+        return LIT
+
+    def decode(self, pc):
+        """
+            Decode the instruction at ``pc``
+
+            Returns ``(op, opcode, m, a_fn, a_arg, b_fn, b_arg, length)`` where
+            ``op`` is None for the halting instruction 0x0000, or TRAP if
+            run_until is to stop there.
+        """
+        if pc in self.traps:
+            return TRAP
+
+        memory = self.memory
+        operands, opcode = divmod(memory[pc], 16)
+        b, a = divmod(operands, 64)
+
+        length = 1
+        if opcode == 0x00:
+            if a == 0x00:
+                return None, 0x00, None, None, None, None, None, 1
+            m = a_fn = a_arg = None
+            opcode = (a << 4) + 0x0
         else:
-            literal = True
-            arg1 = a % 0x20
-            if not dereference:
-                self.memory[LIT] = arg1
-                arg1 = LIT
-
-        if dereference and not literal:
-            arg1 = self.memory[arg1]
-        return arg1
-
-    def run(self, trace=False, show_speed=False):
-        tick = 0
-        last_time = time.time()
-        last_cycle = self.cycle
-        if trace:
-            disassembler = disasm.Disassembler(self.memory)
+            word = (pc + length) % 0x10000
+            operand = OPERANDS[a]
+            m, a_fn, a_arg = operand.destination(self, memory[word], word)
+            length += operand.words
 
-        while True:
-            pc = self.memory[PC]
-            w = self.memory[pc]
-            self.memory[PC] += 1
+        op = self.opcodes[opcode]
+        word = (pc + length) % 0x10000
+        operand = OPERANDS[b]
+        b_fn, b_arg = operand.value(self, memory[word], word)
+        length += operand.words
+
+        for i in range(length):
+            self.code[(pc + i) % 0x10000] = 1
 
+        return op, opcode, m, a_fn, a_arg, b_fn, b_arg, length
+
+    def compile_block(self, pc):
+        """
+            Translate the straight-line code at ``pc`` into a Python function
+
+            A block ends with the first instruction that writes PC, a JSR, or
+            an IFx together with the instruction it may skip. Calling the
+            function executes the block and returns the number of
+            instructions stepped. Returns None if ``pc`` holds the halting
+            instruction.
+        """
+        memory = self.memory
+        if memory[pc] % 0x400 == 0x0000:
+            return None
+
+        source = BlockSource(pc, memory, self.tickers, self.watched)
+        address = pc
+        for count in range(1, BLOCK_LIMIT + 1):
+            w = memory[address]
             operands, opcode = divmod(w, 16)
             b, a = divmod(operands, 64)
+            if count > 1 and address in self.traps:
+                source.exit(address, count - 1)
+                break
+            if opcode == 0x00 and a != 0x01:
+                if count == 1:
+                    # unknown non-basic opcode, fail as the interpreter does
+                    self.opcodes[a << 4]
+                source.exit(address, count - 1)
+                break
+            address = source.instruction(address, opcode, a, b, count)
+            if address is None:
+                break
+            if 0x0c <= opcode <= 0x0f:
+                source.conditional(address, count, address in self.traps)
+                break
+        else:
+            source.exit(address, count)
 
-            if trace:
-                disassembler.offset = pc
-                print("(%08X) %s" % (self.cycle, disassembler.next_instruction()))
+        namespace = {}
+        exec(compile(source.text(), "<block %04x>" % pc, "exec"), namespace)
+        block = namespace["make"](self, memory, self.registers, self.code, self.tickers, self.block_cache, self.watched)
+
+        self.block_cache[pc] = block
+        self.block_addresses[pc] = source.addresses
+        for address in source.addresses:
+            self.code[address] = 1
+            self.block_index.setdefault(address, []).append(pc)
+        return block
+
+    def skip_instruction(self):
+        """Skip the instruction at PC, returning False if it halts"""
+        pc = self.registers[PC]
+        entry = self.decode_cache.get(pc)
+        if entry is None:
+            entry = self.decode_cache[pc] = self.decode(pc)
+        self.registers[PC] = (pc + entry[-1]) % 0x10000
+        if entry[0] is None:
+            return False
+        self.skip = False
+        return True
 
-            if opcode == 0x00:
-                if a == 0x00:
+    def run_blocks(self, budget, steps, check):
+        """
+            Run compiled blocks from the ``steps``th step of a run until
+            stopped, checking ``budget`` once ``check`` steps are reached
+
+            Returns the reason for stopping and the number of steps.
+        """
+        if self.block_plugins != self.plugin_signature:
+            self.clear_blocks()
+            self.block_plugins = self.plugin_signature
+
+        registers = self.registers
+        blocks = self.block_cache
+
+        try:
+            while True:
+                pc = registers[PC]
+                if self.skip:
+                    if pc in self.traps:
+                        return STOP_PC, steps
+                    if not self.skip_instruction():
+                        return STOP_HALT, steps
+                    steps += 1
+                    if self.tickers:
+                        self.instructions += 1
+                        for p in self.tickers:
+                            p.tick(self)
+                else:
+                    block = blocks.get(pc)
+                    if block is None:
+                        if pc in self.traps:
+                            return STOP_PC, steps
+                        if self.block_rewrites.get(pc, 0) < BLOCK_REWRITES:
+                            block = self.compile_block(pc)
+                            if block is None:
+                                registers[PC] = (pc + 1) % 0x10000
+                                return STOP_HALT, steps
+                    if block is not None:
+                        steps += block()
+                    else:
+                        # code that keeps being overwritten, which would cost
+                        # a compilation every time, is interpreted instead
+                        reason, stepped = self.interpret(
+                            Budget(self, None, min(check - steps, BLOCK_LIMIT), None, False, periodic=False), 0, 1)
+                        steps += stepped
+                        if reason != STOP_INSTRUCTIONS:
+                            return reason, steps
+
+                if steps >= check:
+                    reason, check = budget.check(steps)
+                    if reason is not None:
+                        return reason, steps
+        except SystemExit:
+            return STOP_EXIT, steps
+
+    def probe_idle_loop(self, limit=IDLE_PROBE, recorder=None):
+        """
+            Step until the cpu is back in its current state, memory
+            included, without ticking plugins and passing every step to
+            ``recorder``
+
+            Returns whether it came back, which fails if that takes more
+            than ``limit`` steps or the cpu is about to halt or stop at a
+            trap, and the steps and cycles run either way. Of memory, only
+            the words the steps wrote to are compared.
+        """
+        registers = self.registers
+        memory = self.memory
+        state = (registers.tobytes(), self.skip)
+        cycle = self.cycle
+        # the words written to and their values before the probe
+        written = {}
+        steps = 0
+        tickers = self.tickers
+        self.tickers = []
+        try:
+            while steps < limit:
+                pc = registers[PC]
+                if pc in self.traps or memory[pc] % 0x400 == 0x0000:
                     break
-                arg1 = None
-                opcode = (a << 4) + 0x0
+                if not self.skip:
+                    address = self.write_address(pc)
+                    if address is not None and address not in written:
+                        written[address] = memory[address]
+                self.interpret(Budget(self, None, 1, None, False, periodic=False), 0, 1, recorder=recorder)
+                steps += 1
+                if (registers.tobytes(), self.skip) == state:
+                    idle = self.cycle > cycle and all(memory[address] == value for address, value in written.items())
+                    return idle, steps, self.cycle - cycle
+        finally:
+            self.tickers = tickers
+        return False, steps, self.cycle - cycle
+
+    def write_address(self, pc):
+        """The memory address the instruction at ``pc`` writes to, or None"""
+        operands, opcode = divmod(self.memory[pc], 16)
+        b, a = divmod(operands, 64)
+        registers = self.registers
+        if opcode == 0x00:
+            # JSR pushes the return address
+            return (registers[SP] - 1) % 0x10000 if a == 0x01 else None
+        if opcode > 0x0B:
+            return None
+        word = (pc + 1) % 0x10000
+        m, fn, arg = OPERANDS[a].destination(self, self.memory[word], word)
+        if m is not self.memory:
+            return None
+        # resolving PUSH and POP changes SP
+        sp = registers[SP]
+        address = arg if fn is None else fn(arg)
+        registers[SP] = sp
+        return address
+
+    def run_table(self, budget, steps, check):
+        """
+            Execute instructions from the ``steps``th step of a run until
+            stopped, checking ``budget`` once ``check`` steps are reached
+
+            Nothing is cached: every instruction is dispatched afresh
+            through OPERANDS and the dense opcode tables.
+
+            Returns the reason for stopping and the number of steps.
+        """
+        memory = self.memory
+        registers = self.registers
+        operands = OPERANDS
+        basic = self.basic_opcodes
+        nonbasic = self.nonbasic_opcodes
+        code = self.code
+        watched = self.watched
+        tickers = self.tickers
+        traps = self.traps
+
+        while True:
+            pc = registers[PC]
+            if pc in traps:
+                return STOP_PC, steps
+
+            w = memory[pc]
+            opcode = w & 0xF
+            a = (w >> 4) & 0x3F
+            b_operand = operands[w >> 10]
+            if opcode:
+                op = basic[opcode]
+                a_operand = operands[a]
+                length = 1 + a_operand.words + b_operand.words
+            elif a == 0x00:
+                registers[PC] = (pc + 1) % 0x10000
+                return STOP_HALT, steps
             else:
-                arg1 = self.get_operand(a)
+                op = nonbasic[a]
+                if op is None:
+                    # fail as the interpreter does
+                    raise KeyError(a << 4)
+                length = 1 + b_operand.words
+
+            registers[PC] = (pc + length) % 0x10000
+
+            if self.skip:
+                self.skip = False
+            else:
+                # one cycle for every next word
+                self.cycle += length - 1
+                word = (pc + 1) % 0x10000
+                if opcode:
+                    m, fn, arg1 = a_operand.destination(self, memory[word], word)
+                    if fn is not None:
+                        arg1 = fn(arg1)
+                    word = (word + a_operand.words) % 0x10000
+                else:
+                    m = arg1 = None
+                fn, arg2 = b_operand.value(self, memory[word], word)
+                if fn is not None:
+                    arg2 = fn(arg2)
+                if 0 < opcode <= 0xB:  # write to memory or a register
+                    address = arg1 if m is memory else REGISTERS + arg1
+                    if watched[address]:
+                        oldval = m[arg1]
+                        op(m, arg1, arg2)
+                        val = m[arg1]
+                        if oldval != val and self.notify_write(address, val, oldval):
+                            self.trap(registers[PC])
+                    else:
+                        op(m, arg1, arg2)
+                    if code[address]:
+                        self.invalidate(address)
+                else:
+                    op(m, arg1, arg2)
+
+            steps += 1
+            if tickers:
+                # kept current for the writes the plugins journal
+                self.instructions += 1
+                try:
+                    for p in tickers:
+                        p.tick(self)
+                except SystemExit:
+                    return STOP_EXIT, steps
+
+            if steps >= check:
+                reason, check = budget.check(steps)
+                if reason is not None:
+                    return reason, steps
+
+    def interpret(self, budget, steps, check, trace=False, recorder=None):
+        """
+            Interpret instructions from the ``steps``th step of a run until
+            stopped, checking ``budget`` once ``check`` steps are reached,
+            and passing every instruction stepped to ``recorder``
+
+            Returns the reason for stopping and the number of steps.
+        """
+        if trace:
+            disassembler = disasm.Disassembler(self.memory)
+
+        memory = self.memory
+        registers = self.registers
+        cache = self.decode_cache
+        code = self.code
+        watched = self.watched
+        tickers = self.tickers
+        implicit = self.implicit_watches
+
+        while True:
+            pc = registers[PC]
+            entry = cache.get(pc)
+            if entry is None:
+                entry = cache[pc] = self.decode(pc)
+            op, opcode, m, a_fn, a_arg, b_fn, b_arg, length = entry
+
+            if trace and entry is not TRAP:
+                disassembler.offset = pc
+                print("(%08X) %s" % (self.cycle, disassembler.next_instruction()))
 
-            op = self.opcodes[opcode]
-            arg2 = self.get_operand(b, dereference=True)
+            if recorder is not None:
+                # the words as executed, before the instruction can rewrite them
+                words = memory[pc], memory[(pc + 1) % 0x10000], memory[(pc + 2) % 0x10000]
+                cycle = self.cycle
+
+            registers[PC] = (pc + length) % 0x10000
+
+            if op is None:
+                return STOP_PC if entry is TRAP else STOP_HALT, steps
 
             if self.skip:
                 if trace:
                     print("skipping")
                 self.skip = False
             else:
-                if 0x01 <= opcode <= 0xB:  # write to memory
-                    oldval = self.memory[arg1]
-                    op(arg1, arg2)
-                    val = self.memory[arg1]
-                    if oldval != val:
-                        for p in self.plugins:
-                            p.memory_changed(self, arg1, val, oldval)
+                if implicit:
+                    before = [registers[r] for r in implicit]
+                # one cycle for every next word
+                self.cycle += length - 1
+                arg1 = a_arg if a_fn is None else a_fn(a_arg)
+                arg2 = b_arg if b_fn is None else b_fn(b_arg)
+                if opcode <= 0xB:  # write to memory or a register
+                    address = arg1 if m is memory else REGISTERS + arg1
+                    if watched[address]:
+                        oldval = m[arg1]
+                        op(m, arg1, arg2)
+                        val = m[arg1]
+                        if oldval != val and self.notify_write(address, val, oldval):
+                            self.trap(registers[PC])
+                    else:
+                        op(m, arg1, arg2)
+                    if code[address]:
+                        self.invalidate(address)
                 else:
-                    op(arg1, arg2)
+                    op(m, arg1, arg2)
+                if implicit:
+                    for r, value in zip(implicit, before):
+                        if registers[r] != value and self.check_watchpoint(REGISTERS + r):
+                            self.trap(registers[PC])
                 if trace:
                     self.dump_registers()
                     self.dump_stack()
 
-            tick += 1
-            if tick >= 100000:
-                if show_speed:
-                    print("%dkHz" % (int((self.cycle - last_cycle) / (time.time() - last_time)) / 1000))
-                last_time = time.time()
-                last_cycle = self.cycle
-                tick = 0
-            try:
-                for p in self.plugins:
-                    p.tick(self)
-            except SystemExit:
-                break
+            if recorder is not None:
+                recorder.record(self, pc, words, self.cycle - cycle)
+
+            steps += 1
+            if tickers:
+                # kept current for the writes the plugins journal
+                self.instructions += 1
+                try:
+                    for p in tickers:
+                        p.tick(self)
+                except SystemExit:
+                    return STOP_EXIT, steps
+
+            if steps >= check:
+                reason, check = budget.check(steps)
+                if reason is not None:
+                    return reason, steps
+
+    def run_until(self, pc=None, predicate=None, cycles=None, instructions=None,
+                  engine="interpreter", trace=False, show_speed=False, clock=None, recorder=None,
+                  idle=IDLE_SPIN):
+        """
+            Run until execution reaches ``pc``, ``predicate(cpu)`` is true or
+            ``cycles`` or ``instructions`` are used up
+
+            ``pc`` may be a single address or a collection of them; the run
+            stops before executing the instruction there, other than the one
+            it starts at. The budgets are only checked every so often, at
+            most every BLOCK_LIMIT instructions for a predicate, so a run
+            may finish its current instruction or compiled block past them.
+            Instructions skipped by IFx count as steps, as they do for
+            plugin ticks. Only the interpreter is used when tracing, or
+            recording the run into a tracer.TraceRecorder ``recorder``.
+
+            With a ``clock`` rate in Hz, such as CLOCK_RATE, the run is paced
+            to it in slices of THROTTLE_SLICE seconds by the Throttle left
+            in ``self.throttle``.
+
+            With ``idle`` set to IDLE_SLEEP, a loop the cpu keeps coming back
+            to the same state in is found when checking the budgets. Its
+            cycles are then fast-forwarded until a plugin writes to the cpu
+            or a budget runs out, sleeping as long as they would take at the
+            clock rate. IDLE_HALT also stops the run, as halted, if there
+            are no plugins that could write. Plugins ticked after every
+            instruction rule out fast-forwarding.
+
+            The run also stops at ``self.breakpoints`` and after changes to
+            ``self.watchpoints``, as STOP_BREAK with the address in
+            ``self.hit``, once their conditions hold. Both are trapped like
+            ``pc``, so conditions are only evaluated when execution reaches
+            a breakpoint or a watched address changes. Watching SP or O
+            also catches the changes instructions make to them implicitly,
+            as PUSH, POP, JSR and the arithmetic setting O do, but PC is
+            only watched for instructions setting it explicitly.
+
+            Returns a RunResult.
+        """
+        if pc is None:
+            stops = set()
+        elif isinstance(pc, int):
+            stops = set([pc])
+        else:
+            stops = set(pc)
+        breakpoints = self.breakpoints
+
+        self.index_plugins()
+        # blocks and tables only report changes to the registers named as
+        # the destination, so the implicit ones are left to the interpreter
+        if trace or recorder is not None or self.implicit_watches:
+            engine = "interpreter"
+        if engine == "blocks":
+            execute = self.run_blocks
+        elif engine == "table":
+            execute = self.run_table
+        else:
+            def execute(budget, steps, check):
+                return self.interpret(budget, steps, check, trace, recorder)
+
+        start = self.cycle
+        self.throttle = None if clock is None else Throttle(clock, self.cycle)
+        budget = Budget(self, cycles, instructions, predicate, show_speed, throttle=self.throttle, idle=idle,
+                        recorder=recorder)
+        reason, check = budget.check(0)
+        steps = 0
+        self.hit = None
+
+        # watchpoints that are hit add the address of the next instruction
+        traps = self.traps = stops | set(breakpoints)
+        for address in traps:
+            self.invalidate(address)
+        try:
+            # leave the address we start from before stopping there
+            here = self.registers[PC] if self.registers[PC] in traps else None
+            while reason is None:
+                if here is not None:
+                    traps.discard(here)
+                    self.invalidate(here)
+                    reason, stepped = self.interpret(Budget(self, None, 1, None, False, periodic=False), 0, 1, trace, recorder)
+                    steps += stepped
+                    if reason == STOP_INSTRUCTIONS:
+                        reason, check = budget.check(steps)
+                    traps.add(here)
+                    self.invalidate(here)
+                    if reason is not None:
+                        break
+                reason, steps = execute(budget, steps, check)
+                if reason != STOP_PC:
+                    break
+                here = self.registers[PC]
+                if self.hit is not None:
+                    reason = STOP_BREAK
+                elif here not in stops:
+                    condition = breakpoints[here]
+                    if condition is None or condition(self):
+                        self.hit = here
+                        reason = STOP_BREAK
+                    else:
+                        reason = None
+        finally:
+            self.traps = set()
+            for address in traps:
+                self.invalidate(address)
+
+        self.instructions = budget.start + steps + budget.skipped
+        return RunResult(reason, self.cycle - start, steps + budget.skipped)
+
+    def run_for(self, cycles=None, instructions=None, engine="interpreter", clock=None, recorder=None, idle=IDLE_SPIN):
+        """
+            Run for ``cycles`` cycles or ``instructions`` steps, whichever
+            runs out first, or until halted or stopped by a plugin
+
+            Returns a RunResult.
+        """
+        return self.run_until(cycles=cycles, instructions=instructions, engine=engine, clock=clock, recorder=recorder, idle=idle)
+
+    def run(self, trace=False, show_speed=False, engine="interpreter", clock=None, recorder=None, idle=IDLE_SPIN):
+        """Run until halted or stopped by a plugin"""
+        return self.run_until(engine=engine, trace=trace, show_speed=show_speed, clock=clock, recorder=recorder, idle=idle)
+
+    def snapshot(self):
+        """
+            Capture memory, registers, skip and cycle in a Snapshot
+
+            Pages unchanged since the last snapshot taken or restored are
+            shared with it rather than copied.
+        """
+        memory = self.memory
+        last = self.last_snapshot
+        pages = []
+        for i, start in enumerate(range(0, 0x10000, PAGE_SIZE)):
+            page = memory[start:start + PAGE_SIZE].tobytes()
+            if last is not None and last.pages[i] == page:
+                page = last.pages[i]
+            pages.append(page)
+        snapshot = self.last_snapshot = Snapshot(tuple(pages), self.registers.tobytes(), self.skip, self.cycle)
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+            Return to the state captured in ``snapshot``
+
+            Only the pages that differ are copied back. Plugins are told of
+            the changes to the addresses they watch.
+        """
+        memory = self.memory
+        code = self.code
+        watched = self.watched
+        for i, page in enumerate(snapshot.pages):
+            start = i * PAGE_SIZE
+            end = start + PAGE_SIZE
+            old = memory[start:end]
+            if old.tobytes() == page:
+                continue
+            memory[start:end] = new = array("H", page)
+            if code.find(1, start, end) == -1 and watched.find(1, start, end) == -1:
+                continue
+            for address in range(start, end):
+                value, oldvalue = new[address - start], old[address - start]
+                if value != oldvalue:
+                    if watched[address]:
+                        self.notify_write(address, value, oldvalue)
+                    if code[address]:
+                        self.invalidate(address)
+
+        registers = self.registers
+        old = registers[:]
+        registers[:] = array("H", snapshot.registers)
+        if watched.find(1, REGISTERS) != -1:
+            for i in range(0x20):
+                if watched[REGISTERS + i] and registers[i] != old[i]:
+                    self.notify_write(REGISTERS + i, registers[i], old[i])
+
+        self.skip = snapshot.skip
+        self.cycle = snapshot.cycle
+        self.last_snapshot = snapshot
+        self.writes += 1
+
+    def fork(self, snapshot=None, plugins=[]):
+        """
+            A new DCPU16 with ``plugins`` in the state captured in
+            ``snapshot``, by default the current state of this one
+
+            The fork shares the snapshot's pages in its own snapshots.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        cpu = DCPU16([], plugins)
+        cpu.restore(snapshot)
+        return cpu
 
     def dump_registers(self):
         print(" ".join("%s=%04X" % (
             ["A", "B", "C", "X", "Y", "Z", "I", "J"][i],
-            self.memory[0x10000 + i]) for i in range(8)))
-        print("PC={0:04X} SP={1:04X} O={2:04X}".format(*[self.memory[i] for i in (PC, SP, O)]))
+            self.registers[i]) for i in range(8)))
+        print("PC={0:04X} SP={1:04X} O={2:04X}".format(*[self.registers[i] for i in (PC, SP, O)]))
 
     def dump_stack(self):
-        if self.memory[SP] == 0x0:
+        if self.registers[SP] == 0x0:
             print("Stack: []")
         else:
-            print("Stack: [" + " ".join("%04X" % self.memory[m] for m in range(self.memory[SP], 0x10000)) + "]")
+            print("Stack: [" + " ".join("%04X" % self.memory[m] for m in range(self.registers[SP], 0x10000)) + "]")
+
+
+# opcode implementations by opcode, non-basic ones shifted left by four
+OPCODES = dict((func._opcode, func) for func in DCPU16.__dict__.values() if getattr(func, "_is_opcode", False))
 
 
 if __name__ == "__main__":
@@ -268,8 +1618,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="DCPU-16 emulator")
     parser.add_argument("-d", "--debug", action="store_const", const=True, default=False, help="Run emulator in debug mode. This implies '--trace'")
     parser.add_argument("-t", "--trace", action="store_const", const=True, default=False, help="Print dump of registers and stack after every step")
+    parser.add_argument("--trace-file", metavar="FILE", help="Record a binary trace of every step to FILE, to be read with tracer.py")
+    parser.add_argument("-p", "--profile", action="store_const", const=True, default=False, help="Print the addresses the most cycles were spent at on exit")
+    parser.add_argument("--symbols", metavar="FILE", help="Symbol map written by the assembler's '--symbols', to profile by label")
     parser.add_argument("-s", "--speed", action="store_const", const=True, default=False, help="Print speed the emulator is running at in kHz")
-    parser.add_argument("object_file", help="File with assembled DCPU binary")
+    parser.add_argument("-c", "--cycles", type=int, help="Stop after running for this many cycles")
+    parser.add_argument("-r", "--realtime", action="store_const", const=True, default=False, help="Pace the emulator to the clock rate given by '--clock'")
+    parser.add_argument("--clock", type=int, default=CLOCK_RATE, metavar="HZ", help="Clock rate in Hz for '--realtime' (default: %(default)s)")
+    parser.add_argument("-i", "--idle", choices=IDLE_MODES, default=IDLE_SPIN, help="On idle loops keep spinning, fast-forward and sleep, or also stop if nothing can break them (default: %(default)s)")
+    parser.add_argument("-e", "--engine", choices=ENGINES, default="interpreter", help="Execution engine to use (only the interpreter is used with '--trace')")
+    parser.add_argument("-l", "--offset", type=loader.address, default=0, metavar="ADDRESS", help="Address to load the binary at and start running from")
+    parser.add_argument("object_file", help="File with assembled DCPU binary, or '-' for standard input")
 
     for p in plugins:
         for args in p.arguments:
@@ -278,15 +1637,15 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if args.debug:
         args.trace = True
+    if args.profile and args.trace_file:
+        parser.error("'--profile' and '--trace-file' cannot be combined")
+
+    program = loader.load(args.object_file, args.offset)
 
-    program = []
-    with open(args.object_file, "rb") as f:
-        word = f.read(2)
-        while word:
-            program.append(struct.unpack(">H", word)[0])
-            word = f.read(2)
+    recorder = None if args.trace_file is None else tracer.TraceRecorder(path=args.trace_file)
 
     plugins_loaded = []
+    dcpu16 = None
     try:
         for p in plugins:
             p = p(args)
@@ -295,10 +1654,22 @@ if __name__ == "__main__":
                 plugins_loaded.append(p)
 
         dcpu16 = DCPU16(program, plugins_loaded)
+        dcpu16.registers[PC] = args.offset
+        if args.profile:
+            recorder = profiler.Profiler()
 
-        dcpu16.run(trace=args.trace, show_speed=args.speed)
+        runner = next((p for p in plugins_loaded if emuplugin.implements(p, "run")), emuplugin.BasePlugin())
+        runner.run(dcpu16, cycles=args.cycles, engine=args.engine, trace=args.trace, show_speed=args.speed,
+                   clock=args.clock if args.realtime else None, recorder=recorder, idle=args.idle)
+        if args.speed and dcpu16.throttle is not None:
+            throttle = dcpu16.throttle
+            print("max drift %.1fms, %d missed deadlines, slept %.1fs" % (throttle.max_drift * 1000, throttle.missed, throttle.slept))
     except KeyboardInterrupt:
         pass
     finally:
         for p in plugins_loaded:
             p.shutdown()
+        if args.profile and dcpu16 is not None:
+            recorder.report(None if args.symbols is None else profiler.read_symbols(args.symbols), dcpu16.memory)
+        elif recorder is not None:
+            recorder.close()
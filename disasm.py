@@ -2,10 +2,11 @@
 
 from __future__ import print_function
 
-import struct
 import sys
 import argparse
 
+import loader
+
 
 INSTRUCTIONS = [None, "SET", "ADD", "SUB", "MUL", "DIV", "MOD", "SHL", "SHR", "AND", "BOR", "XOR", "IFE", "IFN", "IFG", "IFB"]
 IDENTIFERS = ["A", "B", "C", "X", "Y", "Z", "I", "J", "POP", "PEEK", "PUSH", "SP", "PC", "O"]
@@ -66,19 +67,13 @@ class Disassembler:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="DCPU-16 disassembler")
     parser.add_argument("-o", help="Place the output into FILE instead of stdout", metavar="FILE")
-    parser.add_argument("input", help="File with DCPU object code")
+    parser.add_argument("-l", "--offset", type=loader.address, default=0, metavar="ADDRESS", help="Address the object code is loaded at")
+    parser.add_argument("input", help="File with DCPU object code, or '-' for standard input")
     args = parser.parse_args()
 
-    program = []
-    if args.input == "-":
-        f = sys.stdin
-    else:
-        f = open(args.input, "rb")
-    word = f.read(2)
-    while word:
-        program.append(struct.unpack(">H", word)[0])
-        word = f.read(2)
+    program = loader.load(args.input, args.offset)
 
     output = sys.stdout if args.o is None else open(args.o, "w")
     d = Disassembler(program, output=output)
+    d.offset = args.offset
     d.run()
@@ -16,10 +16,19 @@ def _load(path):
     return imp.load_source(name, path)
 
 
+def implements(plugin, hook):
+    """Whether plugin overrides the no-op hook method of BasePlugin"""
+    method = getattr(plugin.__class__, hook, None)
+    if method is None:
+        return False
+    return getattr(method, "__func__", method) is not getattr(BasePlugin.__dict__[hook], "__func__", BasePlugin.__dict__[hook])
+
+
 class BasePlugin:
     """
         Plugin module to interface with a cpu core.
 
+        The cpu only calls the hooks a plugin overrides.
 
         Signaling a shutdown should be done via raising SystemExit within tick()
     """
@@ -33,6 +42,13 @@ class BasePlugin:
     # Set in __init__ if you do not wish to have been "loaded" or called
     loaded = True
 
+    # Number of instructions between calls to tick()
+    tick_interval = 1
+
+    # Addresses, as a list of inclusive (first, last) pairs, that
+    # memory_changed() is called for; None for all of them
+    memory_ranges = None
+
     def tick(self, cpu):
         """
             Gets called at the end of every cpu tick
@@ -51,6 +67,13 @@ class BasePlugin:
         """
         pass
 
+    def run(self, cpu, **options):
+        """
+            Gets called to run the cpu in place of cpu.run_until, with the
+            same keyword arguments, by the first plugin overriding it
+        """
+        return cpu.run_until(**options)
+
     def __init__(self, args=None):
         self.name = self.__class__.__name__ if not self.name else self.name
 
@@ -0,0 +1,178 @@
+import bisect
+import collections
+
+import dcpu16
+from emuplugin import BasePlugin
+
+
+# instructions between checkpoints, and so about the most that taking the
+# cpu back to any instruction has to replay
+CHECKPOINT_INTERVAL = 10000
+
+# bytes of memory pages the checkpoints may hold before the oldest go
+HISTORY_BUDGET = 64 * 1024 * 1024
+
+# bytes held by a page of a snapshot
+PAGE_BYTES = dcpu16.PAGE_SIZE * 2
+
+
+Checkpoint = collections.namedtuple("Checkpoint", "instructions snapshot journal")
+Checkpoint.__doc__ = """
+    A snapshot taken once ``instructions`` instructions were stepped, and
+    the writes made through DCPU16.write since, as journaled by the cpu
+"""
+
+
+class History(BasePlugin):
+    """
+        Checkpoints and a journal of writes letting a DCPU16 go back to any
+        instruction stepped since recording began
+
+        Being ticked every ``interval`` instructions, a checkpoint is taken
+        with DCPU16.snapshot, so unchanged pages are shared between them.
+        Execution is deterministic but for the writes plugins make, which
+        the cpu journals with its instruction count. Going back replays a
+        fork without plugins from the checkpoint before the instruction,
+        applying the journaled writes on the way, and the cpu is restored to
+        the fork's state. Once the pages held exceed ``budget`` bytes the
+        oldest checkpoints are dropped.
+    """
+
+    def __init__(self, cpu, interval=CHECKPOINT_INTERVAL, budget=HISTORY_BUDGET):
+        BasePlugin.__init__(self)
+        self.cpu = cpu
+        self.tick_interval = interval
+        self.budget = budget
+        self.checkpoints = []
+        # references to every page held by the checkpoints, keyed by id
+        self.pages = {}
+        self.size = 0
+        self.checkpoint()
+
+    def tick(self, cpu):
+        self.update()
+
+    def update(self):
+        """
+            Take a checkpoint if ``interval`` instructions were stepped since
+            the last one, as after going back the tick may come late
+        """
+        if self.cpu.instructions - self.checkpoints[-1].instructions >= self.tick_interval:
+            self.checkpoint()
+
+    def shutdown(self):
+        self.cpu.journal = None
+
+    def checkpoint(self):
+        """Take a checkpoint, dropping the oldest ones if over budget"""
+        cpu = self.cpu
+        snapshot = cpu.snapshot()
+        for page in snapshot.pages:
+            key = id(page)
+            if key in self.pages:
+                self.pages[key][1] += 1
+            else:
+                self.pages[key] = [page, 1]
+                self.size += PAGE_BYTES
+        cpu.journal = []
+        self.checkpoints.append(Checkpoint(cpu.instructions, snapshot, cpu.journal))
+        while self.size > self.budget and len(self.checkpoints) > 1:
+            self.drop(0)
+
+    def drop(self, index):
+        """Drop the ``index``th checkpoint and the pages only it held"""
+        for page in self.checkpoints.pop(index).snapshot.pages:
+            key = id(page)
+            self.pages[key][1] -= 1
+            if not self.pages[key][1]:
+                del self.pages[key]
+                self.size -= PAGE_BYTES
+
+    def oldest(self):
+        """The earliest instruction the cpu can go back to"""
+        return self.checkpoints[0].instructions
+
+    def replay(self, index, instructions, hits=None):
+        """
+            A fork of the cpu at the ``index``th checkpoint, run until
+            ``instructions`` instructions were stepped with the journaled
+            writes made on the way
+
+            With a list for ``hits``, the fork stops at the breakpoints and
+            watchpoints of the cpu, appending the instruction count and the
+            address of each one hit.
+        """
+        cpu = self.cpu
+        checkpoint = self.checkpoints[index]
+        fork = cpu.fork(checkpoint.snapshot)
+        fork.instructions = checkpoint.instructions
+        if hits is not None:
+            fork.breakpoints = cpu.breakpoints
+            fork.watchpoints = cpu.watchpoints
+            # the run does not stop at the address it starts from
+            pc = fork.registers[dcpu16.PC]
+            if pc in fork.breakpoints:
+                condition = fork.breakpoints[pc]
+                if condition is None or condition(fork):
+                    hits.append((fork.instructions, pc))
+
+        writes = [write for c in self.checkpoints[index:] for write in c.journal if write[0] <= instructions]
+        for position, address, value in writes + [(instructions, None, None)]:
+            while fork.instructions < position:
+                result = fork.run_for(instructions=position - fork.instructions)
+                if result.reason == dcpu16.STOP_BREAK:
+                    hits.append((fork.instructions, fork.hit))
+                elif result.reason != dcpu16.STOP_INSTRUCTIONS:
+                    break
+            if address is not None:
+                fork.write(address, value)
+        return fork
+
+    def go(self, instructions):
+        """
+            Take the cpu back to when ``instructions`` instructions were
+            stepped, forgetting what came after
+        """
+        cpu = self.cpu
+        instructions = max(instructions, self.oldest())
+        index = bisect.bisect_right([c.instructions for c in self.checkpoints], instructions) - 1
+        fork = self.replay(index, instructions)
+        while len(self.checkpoints) > index + 1:
+            self.drop(index + 1)
+        journal = self.checkpoints[index].journal
+        journal[:] = [write for write in journal if write[0] <= instructions]
+
+        cpu.restore(fork.snapshot())
+        cpu.instructions = fork.instructions
+        cpu.journal = journal
+        return fork.instructions
+
+    def back(self, count=1):
+        """Take the cpu back ``count`` instructions, returning how many it went"""
+        start = self.cpu.instructions
+        return start - self.go(start - count)
+
+    def back_to_hit(self):
+        """
+            Take the cpu back to the last breakpoint or watchpoint hit
+            before its current instruction, or as far back as it can go
+
+            Returns the address hit, or None.
+        """
+        cpu = self.cpu
+        end = cpu.instructions
+        for index in reversed(range(len(self.checkpoints))):
+            start = self.checkpoints[index].instructions
+            if start >= end:
+                continue
+            hits = []
+            self.replay(index, end, hits)
+            hits = [hit for hit in hits if hit[0] < end]
+            if hits:
+                instructions, address = hits[-1]
+                self.go(instructions)
+                cpu.hit = address
+                return address
+            end = start
+        self.go(self.oldest())
+        return None
@@ -0,0 +1,55 @@
+import os
+import sys
+from array import array
+
+
+def read_words(f):
+    """
+        Read the rest of the binary file ``f`` as big-endian words into an
+        array('H') in one go
+    """
+    words = array("H")
+    try:
+        size = os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, OSError, ValueError):
+        size = None
+    if size is not None and size >= 0 and size % 2 == 0:
+        try:
+            words.fromfile(f, size // 2)
+        except EOFError:
+            pass
+    else:
+        data = f.read()
+        if len(data) % 2:
+            # a trailing odd byte is the high byte of the last word
+            data += b"\x00"
+        words.frombytes(data)
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
+
+
+def load(path, offset=0):
+    """
+        Load the object file at ``path``, or standard input for "-", as an
+        array('H') memory image with the file's first word at ``offset``
+
+        The image covers at most 0x10000 words.
+    """
+    if path == "-":
+        words = read_words(getattr(sys.stdin, "buffer", sys.stdin))
+    else:
+        with open(path, "rb") as f:
+            words = read_words(f)
+    if offset:
+        words = array("H", [0]) * offset + words
+    del words[0x10000:]
+    return words
+
+
+def address(value):
+    """argparse type for addresses, given in decimal or with a 0x prefix"""
+    value = int(value, 0)
+    if not 0 <= value < 0x10000:
+        raise ValueError(value)
+    return value
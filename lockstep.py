@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+import argparse
+from array import array
+import time
+
+import numpy as np
+
+import dcpu16
+import loader
+from dcpu16 import SP, PC, O, LIT, OPERANDS, RunResult, STOP_HALT, STOP_CYCLES, STOP_INSTRUCTIONS
+
+
+# reason for a machine to stop at an opcode DCPU16 has no implementation for
+STOP_FAULT = "fault"
+
+
+class Lockstep:
+    """
+        A batch of DCPU-16 machines held in NumPy arrays and stepped together
+
+        Each step executes one instruction on every running machine. The
+        machines are grouped by the instruction word at their PC, and each
+        group is executed with vectorized operations however their PCs,
+        memory and registers differ, so machines running the same code stay
+        fast after diverging. The semantics, cycle counts included, follow
+        DCPU16's opcodes. There are no plugins.
+    """
+
+    def __init__(self, memory, count=1):
+        """
+            ``memory`` is either one program, loaded into ``count`` machines,
+            or a two-dimensional array holding a program for each machine
+        """
+        memory = np.asarray(memory, dtype=np.uint16)
+        if memory.ndim == 1:
+            memory = memory.reshape(1, -1).repeat(count, axis=0)
+        self.count = len(memory)
+
+        self.memory = np.zeros((self.count, 0x10000), dtype=np.uint16)
+        self.memory[:, :memory.shape[1]] = memory[:, :0x10000]
+
+        # laid out like DCPU16.registers, one row per machine
+        self.registers = np.zeros((self.count, 0x20), dtype=np.uint16)
+
+        self.skip = np.zeros(self.count, dtype=bool)
+        self.cycle = np.zeros(self.count, dtype=np.int64)
+        self.instructions = np.zeros(self.count, dtype=np.int64)
+        self.halted = np.zeros(self.count, dtype=bool)
+        self.faulted = np.zeros(self.count, dtype=bool)
+
+    def running(self):
+        """Boolean mask of the machines that have neither halted nor faulted"""
+        return ~(self.halted | self.faulted)
+
+    def destination(self, ix, a, word):
+        """
+            Resolve operand ``a`` of the machines ``ix`` as a destination,
+            where ``word`` holds the address of its next word on each
+
+            Returns ``(store, target)`` such that the operand is
+            ``store[ix, target]``.
+        """
+        memory = self.memory
+        registers = self.registers
+        if a < 0x08 or 0x1B <= a <= 0x1D:
+            return registers, a
+        elif a < 0x10:
+            return memory, registers[ix, a % 0x08]
+        elif a < 0x18:
+            return memory, (memory[ix, word].astype(np.int64) + registers[ix, a % 0x10]) & 0xFFFF
+        elif a == 0x18:
+            sp = registers[ix, SP]
+            registers[ix, SP] = (sp.astype(np.int64) + 1) & 0xFFFF
+            return memory, sp
+        elif a == 0x19:
+            return memory, registers[ix, SP]
+        elif a == 0x1A:
+            sp = (registers[ix, SP].astype(np.int64) - 1) & 0xFFFF
+            registers[ix, SP] = sp
+            return memory, sp
+        elif a == 0x1E:
+            return memory, memory[ix, word]
+        elif a == 0x1F:
+            # as a destination this is the next word itself
+            return memory, word
+        else:
+            registers[ix, LIT] = a % 0x20
+            return registers, LIT
+
+    def value(self, ix, b, word):
+        """
+            Evaluate operand ``b`` of the machines ``ix``, where ``word``
+            holds the address of its next word on each
+        """
+        memory = self.memory
+        registers = self.registers
+        if b < 0x08 or 0x1B <= b <= 0x1D:
+            value = registers[ix, b]
+        elif b < 0x10:
+            value = memory[ix, registers[ix, b % 0x08]]
+        elif b < 0x18:
+            value = memory[ix, (memory[ix, word].astype(np.int64) + registers[ix, b % 0x10]) & 0xFFFF]
+        elif b == 0x18:
+            sp = registers[ix, SP]
+            registers[ix, SP] = (sp.astype(np.int64) + 1) & 0xFFFF
+            value = memory[ix, sp]
+        elif b == 0x19:
+            value = memory[ix, registers[ix, SP]]
+        elif b == 0x1A:
+            sp = (registers[ix, SP].astype(np.int64) - 1) & 0xFFFF
+            registers[ix, SP] = sp
+            value = memory[ix, sp]
+        elif b == 0x1E:
+            value = memory[ix, memory[ix, word]]
+        elif b == 0x1F:
+            value = memory[ix, word]
+        else:
+            return b % 0x20
+        return value.astype(np.int64)
+
+    def execute(self, w, ix):
+        """Execute the instruction word ``w`` at the PC of each of the machines ``ix``"""
+        memory = self.memory
+        registers = self.registers
+
+        operands, opcode = divmod(w, 16)
+        b, a = divmod(operands, 64)
+        pc = registers[ix, PC].astype(np.int64)
+
+        if opcode == 0x00:
+            if a == 0x00:
+                registers[ix, PC] = (pc + 1) & 0xFFFF
+                self.halted[ix] = True
+                return
+            if a != 0x01:
+                self.faulted[ix] = True
+                return
+            opcode = 0x10
+            length = 1
+        else:
+            length = 1 + OPERANDS[a].words
+        b_offset = length
+        length += OPERANDS[b].words
+
+        registers[ix, PC] = (pc + length) & 0xFFFF
+        self.instructions[ix] += 1
+
+        skipped = self.skip[ix]
+        if skipped.any():
+            self.skip[ix[skipped]] = False
+            ix = ix[~skipped]
+            pc = pc[~skipped]
+            if not len(ix):
+                return
+
+        cycle = self.cycle
+        # one cycle for every next word
+        cycle[ix] += length - 1
+
+        if opcode == 0x10:
+            value = self.value(ix, b, (pc + b_offset) & 0xFFFF)
+            sp = (registers[ix, SP].astype(np.int64) - 1) & 0xFFFF
+            registers[ix, SP] = sp
+            memory[ix, sp] = registers[ix, PC]
+            registers[ix, PC] = value
+            cycle[ix] += 2
+            return
+
+        store, target = self.destination(ix, a, (pc + 1) & 0xFFFF)
+        b = self.value(ix, b, (pc + b_offset) & 0xFFFF)
+        d = store[ix, target].astype(np.int64)
+
+        if opcode >= 0x0c:
+            if opcode == 0x0c:
+                skip = d != b
+            elif opcode == 0x0d:
+                skip = d == b
+            elif opcode == 0x0e:
+                skip = d <= b
+            else:
+                skip = (d & b) == 0
+            self.skip[ix] = skip
+            cycle[ix] += np.where(skip, 3, 0)
+            return
+
+        # ADD and SUB set O before writing the destination, the others after
+        o = None
+        if opcode == 0x01:
+            v = b
+        elif opcode == 0x02:
+            v = d + b
+            registers[ix, O] = v >> 16
+            v &= 0xFFFF
+        elif opcode == 0x03:
+            v = d - b
+            registers[ix, O] = np.where(v < 0, 0xFFFF, 0)
+            v &= 0xFFFF
+        elif opcode == 0x04:
+            v = d * b
+            o = (v >> 16) & 0xFFFF
+            v &= 0xFFFF
+        elif opcode == 0x05:
+            divisor = np.where(b == 0, 1, b)
+            v = np.where(b == 0, 0, d // divisor & 0xFFFF)
+            o = np.where(b == 0, 0, ((d << 16) // divisor) & 0xFFFF)
+        elif opcode == 0x06:
+            v = np.where(b == 0, 0, d % np.where(b == 0, 1, b))
+        elif opcode == 0x07:
+            # shifts past 32 leave nothing in either word
+            v = d << np.minimum(b, 32)
+            o = (v >> 16) & 0xFFFF
+            v &= 0xFFFF
+        elif opcode == 0x08:
+            shift = np.minimum(b, 32)
+            v = d >> shift
+            o = ((d << 16) >> shift) & 0xFFFF
+        elif opcode == 0x09:
+            v = d & b
+        elif opcode == 0x0a:
+            v = d | b
+        else:
+            v = d ^ b
+
+        store[ix, target] = v
+        if o is not None:
+            registers[ix, O] = o
+        cycle[ix] += dcpu16.BLOCK_CYCLES[opcode]
+
+    def step(self, machines=None):
+        """
+            Execute one instruction on each of ``machines``, by default every
+            running machine
+
+            Returns the number of machines stepped.
+        """
+        if machines is None:
+            machines = np.flatnonzero(self.running())
+        if not len(machines):
+            return 0
+
+        words = self.memory[machines, self.registers[machines, PC]]
+        order = np.argsort(words, kind="stable")
+        machines = machines[order]
+        words = words[order]
+        starts = np.flatnonzero(np.concatenate(([True], words[1:] != words[:-1])))
+        ends = np.append(starts[1:], len(words))
+        for start, end in zip(starts, ends):
+            self.execute(int(words[start]), machines[start:end])
+        return len(machines)
+
+    def run(self, cycles=None, instructions=None):
+        """
+            Step the machines until each has halted, faulted, used up
+            ``cycles`` cycles or stepped ``instructions`` times
+
+            Returns a RunResult for each machine, with a reason of STOP_FAULT
+            for machines that met an unknown opcode.
+        """
+        start_cycle = self.cycle.copy()
+        start_instructions = self.instructions.copy()
+        limit = None if cycles is None else start_cycle + cycles
+
+        steps = 0
+        while instructions is None or steps < instructions:
+            running = self.running()
+            if limit is not None:
+                running &= self.cycle < limit
+            if not self.step(np.flatnonzero(running)):
+                break
+            steps += 1
+
+        results = []
+        for i in range(self.count):
+            if self.halted[i]:
+                reason = STOP_HALT
+            elif self.faulted[i]:
+                reason = STOP_FAULT
+            elif limit is not None and self.cycle[i] >= limit[i]:
+                reason = STOP_CYCLES
+            else:
+                reason = STOP_INSTRUCTIONS
+            results.append(RunResult(reason, int(self.cycle[i] - start_cycle[i]),
+                                     int(self.instructions[i] - start_instructions[i])))
+        return results
+
+    def machine(self, i, plugins=[]):
+        """A DCPU16 in the state of the ``i``th machine"""
+        cpu = dcpu16.DCPU16(self.memory[i].tolist(), plugins)
+        cpu.registers[:] = array("H", self.registers[i].tolist())
+        cpu.skip = bool(self.skip[i])
+        cpu.cycle = int(self.cycle[i])
+        return cpu
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a DCPU-16 binary on a batch of machines in lockstep")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="Number of machines to run")
+    parser.add_argument("-c", "--cycles", type=int, help="Stop each machine after running for this many cycles")
+    parser.add_argument("-i", "--instructions", type=int, help="Stop after this many steps")
+    parser.add_argument("object_file", help="File with assembled DCPU binary")
+    args = parser.parse_args()
+
+    lockstep = Lockstep(loader.load(args.object_file), args.count)
+    start = time.time()
+    results = lockstep.run(args.cycles, args.instructions)
+    elapsed = time.time() - start
+
+    reasons = {}
+    for result in results:
+        reasons[result.reason] = reasons.get(result.reason, 0) + 1
+    print(" ".join("%s=%d" % item for item in sorted(reasons.items())))
+    print("%dkHz per machine, %dkHz total" % (
+        int(sum(r.cycles for r in results) / lockstep.count / elapsed / 1000),
+        int(sum(r.cycles for r in results) / elapsed / 1000)))
@@ -1,5 +1,7 @@
 from emuplugin import BasePlugin
 import dcpu16
+import history
+import operator
 
 try:
     raw_input
@@ -7,66 +9,126 @@ except NameError:
     # Python3 raw_input was renamed to input
     raw_input = input
 
+# comparisons allowed in the conditions of breakpoints and watchpoints
+CONDITIONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
 
 class DebuggerPlugin(BasePlugin):
     """
         A plugin to implement a debugger
+
+        It runs the cpu itself, one instruction at a time while stepping.
+        Breakpoints and watchpoints are left to the cpu, so continuing runs
+        at full speed, untraced, until one of them is hit. A history.History
+        records the run for reverse execution.
     """
 
+    arguments = [
+        (["--history"], dict(type=int, default=history.HISTORY_BUDGET // 2 ** 20, metavar="MB", help="Memory for the debugger's reverse execution history in MB (default: %(default)s)")),
+        (["--checkpoint-interval"], dict(type=int, default=history.CHECKPOINT_INTERVAL, metavar="N", help="Instructions between checkpoints of the debugger's history, the most a reverse step replays (default: %(default)s)"))]
+
     def __init__(self, args):
         """
             Enable debugger if args.debug is True
         """
         BasePlugin.__init__(self)
         self.loaded = args.debug
-        self.debugger_breaks = set()
         self.debugger_in_continue = False
+        self.history_budget = args.history * 2 ** 20
+        self.checkpoint_interval = args.checkpoint_interval
 
-    def tick(self, cpu):
+    def run(self, cpu, cycles=None, trace=False, idle=dcpu16.IDLE_SPIN, **options):
         self.cpu = cpu
-        if not self.debugger_in_continue or cpu.memory[dcpu16.PC] in self.debugger_breaks:
-            self.debugger_in_continue = False
-            while True:
+        self.history = history.History(cpu, self.checkpoint_interval, self.history_budget)
+        cpu.plugins.append(self.history)
+        start = cpu.cycle
+        instructions = 0
+        while True:
+            if not self.debugger_in_continue:
                 try:
-                    command = [s.lower() for s in raw_input("debug> ").split()]
-                except EOFError:
-                    # Ctrl-D
-                    print("")
-                    raise SystemExit
-                try:
-                    if not command or command[0] in ("step", "st"):
-                        break
-                    elif command[0] == "help":
-                        help_msg = """Commands:
+                    self.debugger_prompt()
+                except SystemExit:
+                    return dcpu16.RunResult(dcpu16.STOP_EXIT, cpu.cycle - start, instructions)
+            remaining = None if cycles is None else max(cycles - (cpu.cycle - start), 0)
+            if self.debugger_in_continue:
+                result = cpu.run_until(cycles=remaining, idle=idle, **options)
+            else:
+                result = cpu.run_until(cycles=remaining, instructions=1, trace=trace, **options)
+            instructions += result.instructions
+            self.history.update()
+            if cpu.hit is not None:
+                self.debugger_in_continue = False
+                if cpu.hit in cpu.breakpoints and cpu.hit == cpu.registers[dcpu16.PC]:
+                    print("Breakpoint at {0}".format(hex(cpu.hit)))
+                else:
+                    print("Watchpoint {0} changed to {1}".format(self.debugger_location_name(cpu.hit), hex(cpu.read(cpu.hit))))
+            if result.reason not in (dcpu16.STOP_INSTRUCTIONS, dcpu16.STOP_BREAK):
+                return dcpu16.RunResult(result.reason, cpu.cycle - start, instructions)
+
+    def debugger_prompt(self):
+        while True:
+            try:
+                command = [s.lower() for s in raw_input("debug> ").split()]
+            except EOFError:
+                # Ctrl-D
+                print("")
+                raise SystemExit
+            try:
+                if not command or command[0] in ("step", "st"):
+                    break
+                elif command[0] == "help":
+                    help_msg = """Commands:
 help
 st[ep] - (or simply newline) - execute next instruction
 g[et] <address>|%<register> - (also p[rint]) - print value of memory cell or register
 s[et] <address>|%<register> <value_in_hex> - set value of memory cell or register to <value_in_hex>
-b[reak] <address> [<address2>...] - set breakpoint at given addresses (to be used with 'continue')
+b[reak] <address> [<address2>...] [if <condition>] - set breakpoint at given addresses (to be used with 'continue')
 cl[ear] <address> [<address2>...] - remove breakpoints from given addresses
-c[ont[inue]] - run without debugging prompt until breakpoint is encountered
+w[atch] <address>|%<register> [...] [if <condition>] - stop after an instruction changes the value of given memory cells or registers
+unw[atch] <address>|%<register> [...] - remove watchpoints from given memory cells or registers
+c[ont[inue]] - run without debugging prompt until breakpoint or watchpoint is encountered
+rs, reverse-step [<count>] - go back one instruction, or <count> instructions
+rc, reverse-continue - go back to the last breakpoint or watchpoint encountered, or as far as the history goes
 
+Conditions are <address>|%<register> ==|!=|<|<=|>|>= <value_in_hex>, checked when the breakpoint is reached or the watched value changes
 All addresses are in hex (you can add '0x' at the beginning)
 Close emulator with Ctrl-D
 """
-                        print(help_msg)
-                    elif command[0] in ("get", "g", "print", "p"):
-                        self.debugger_get(*command[1:])
-                    elif command[0] in ("set", "s"):
-                        self.debugger_set(*command[1:])
-                    elif command[0] in ("break", "b"):
-                        if len(command) < 2:
-                            raise ValueError("Break command takes at least 1 parameter!")
-                        self.debugger_break(*command[1:])
-                    elif command[0] in ("clear", "cl"):
-                        self.debugger_clear(*command[1:])
-                    elif command[0] in ("continue", "cont", "c"):
-                        self.debugger_in_continue = True
-                        break
-                    else:
-                        raise ValueError("Invalid command!")
-                except ValueError as ex:
-                    print(ex)
+                    print(help_msg)
+                elif command[0] in ("get", "g", "print", "p"):
+                    self.debugger_get(*command[1:])
+                elif command[0] in ("set", "s"):
+                    self.debugger_set(*command[1:])
+                elif command[0] in ("break", "b"):
+                    if len(command) < 2:
+                        raise ValueError("Break command takes at least 1 parameter!")
+                    self.debugger_break(*command[1:])
+                elif command[0] in ("clear", "cl"):
+                    self.debugger_clear(*command[1:])
+                elif command[0] in ("watch", "w"):
+                    if len(command) < 2:
+                        raise ValueError("Watch command takes at least 1 parameter!")
+                    self.debugger_watch(*command[1:])
+                elif command[0] in ("unwatch", "unw"):
+                    self.debugger_unwatch(*command[1:])
+                elif command[0] in ("continue", "cont", "c"):
+                    self.debugger_in_continue = True
+                    break
+                elif command[0] in ("reverse-step", "rs"):
+                    self.debugger_reverse_step(*command[1:])
+                elif command[0] in ("reverse-continue", "rc"):
+                    self.debugger_reverse_continue()
+                else:
+                    raise ValueError("Invalid command!")
+            except ValueError as ex:
+                print(ex)
 
     @staticmethod
     def debugger_parse_location(what):
@@ -75,9 +137,9 @@ Close emulator with Ctrl-D
         if what.startswith("%"):
             what = what[1:]
             if what in registers:
-                return 0x10000 + registers.find(what)
+                return dcpu16.REGISTERS + registers.find(what)
             elif what in specials:
-                return (dcpu16.PC, dcpu16.SP, dcpu16.O)[specials.index(what)]
+                return dcpu16.REGISTERS + (dcpu16.PC, dcpu16.SP, dcpu16.O)[specials.index(what)]
             else:
                 raise ValueError("Invalid register!")
         else:
@@ -86,18 +148,47 @@ Close emulator with Ctrl-D
                 raise ValueError("Invalid address!")
             return addr
 
-    def debugger_break(self, *addrs):
+    @staticmethod
+    def debugger_location_name(addr):
+        if addr < dcpu16.REGISTERS:
+            return hex(addr)
+        index = addr - dcpu16.REGISTERS
+        if index < 8:
+            return "%" + "abcxyzij"[index]
+        return "%" + ("pc", "sp", "o")[(dcpu16.PC, dcpu16.SP, dcpu16.O).index(index)]
+
+    @classmethod
+    def debugger_parse_condition(cls, args):
+        """
+            Split ``args`` at "if", returning the arguments before it and
+            the condition after it as a function of the cpu, or None
+        """
+        if "if" not in args:
+            return args, None
+        i = args.index("if")
+        if len(args) != i + 4 or args[i + 2] not in CONDITIONS:
+            raise ValueError("Invalid condition!")
+        addr = cls.debugger_parse_location(args[i + 1])
+        compare = CONDITIONS[args[i + 2]]
+        value = int(args[i + 3], 16)
+        if not 0 <= value <= 0xFFFF:
+            raise ValueError("Invalid value!")
+        return args[:i], lambda cpu: compare(cpu.read(addr), value)
+
+    def debugger_break(self, *args):
+        addrs, condition = self.debugger_parse_condition(args)
         breaks = set()
         for addr in addrs:
             addr = int(addr, 16)
             if not 0 <= addr <= 0xFFFF:
                 raise ValueError("Invalid address!")
             breaks.add(addr)
-        self.debugger_breaks.update(breaks)
+        for addr in breaks:
+            self.cpu.breakpoints[addr] = condition
 
     def debugger_clear(self, *addrs):
         if not addrs:
-            self.debugger_breaks = set()
+            self.cpu.breakpoints.clear()
         else:
             breaks = set()
             for addr in addrs:
@@ -105,18 +196,59 @@ Close emulator with Ctrl-D
                 if not 0 <= addr <= 0xFFFF:
                     raise ValueError("Invalid address!")
                 breaks.add(addr)
-            self.debugger_breaks.difference_update(breaks)
+            for addr in breaks:
+                self.cpu.breakpoints.pop(addr, None)
+
+    def debugger_watch(self, *args):
+        whats, condition = self.debugger_parse_condition(args)
+        addrs = [self.debugger_parse_location(what) for what in whats]
+        if dcpu16.REGISTERS + dcpu16.PC in addrs:
+            # every instruction moves PC on, breakpoints are what stop at it
+            raise ValueError("PC can't be watched, use break instead!")
+        for addr in addrs:
+            self.cpu.watchpoints[addr] = condition
+
+    def debugger_unwatch(self, *whats):
+        if not whats:
+            self.cpu.watchpoints.clear()
+        else:
+            addrs = [self.debugger_parse_location(what) for what in whats]
+            for addr in addrs:
+                self.cpu.watchpoints.pop(addr, None)
+
+    def debugger_reverse_step(self, count="1"):
+        count = int(count)
+        if count < 1:
+            raise ValueError("Invalid count!")
+        if not self.history.back(count):
+            print("No more history")
+        self.debugger_show_position()
+
+    def debugger_reverse_continue(self):
+        hit = self.history.back_to_hit()
+        if hit is None:
+            print("No breakpoint or watchpoint hit in history")
+        elif hit in self.cpu.breakpoints and hit == self.cpu.registers[dcpu16.PC]:
+            print("Breakpoint at {0}".format(hex(hit)))
+        else:
+            print("Watchpoint {0} changed to {1}".format(self.debugger_location_name(hit), hex(self.cpu.read(hit))))
+        self.debugger_show_position()
+
+    def debugger_show_position(self):
+        print("Instruction {0}, cycle {1}".format(self.cpu.instructions, self.cpu.cycle))
+        self.cpu.dump_registers()
+        self.cpu.dump_stack()
 
     def debugger_set(self, what, value):
         value = int(value, 16)
         if not 0 <= value <= 0xFFFF:
             raise ValueError("Invalid value!")
         addr = self.debugger_parse_location(what)
-        self.cpu.memory[addr] = value
+        self.cpu.write(addr, value)
 
     def debugger_get(self, what):
         addr = self.debugger_parse_location(what)
-        value = self.cpu.memory[addr]
+        value = self.cpu.read(addr)
         print("hex: {hex}\ndec: {dec}\nbin: {bin}".format(hex=hex(value), dec=value, bin=bin(value)))
 
 plugin = DebuggerPlugin
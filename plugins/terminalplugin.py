@@ -1,4 +1,6 @@
 from emuplugin import BasePlugin
+from array import array
+import collections
 import importlib
 import sys
 import time
@@ -8,53 +10,127 @@ import re
 START_ADDRESS = 0x8000
 MIN_DISPLAY_HZ = 60
 
+# the ring of words keys are written to, each zeroed by the program once read
+KEYBOARD_ADDRESS = 0x9000
+KEYBOARD_SIZE = 16
+
+# instructions between updates of the display and keyboard
+TICK_INTERVAL = 1000
+
 
 class TerminalPlugin(BasePlugin):
     """
         A plugin to implement terminal selection
+
+        Writes to video memory go to a shadow copy and are drawn once per
+        frame, only for the cells changed since the last one. Terminals
+        implementing update_characters(runs) are handed all of them at once
+        as runs of ``(row, column, characters, colors)`` of consecutive
+        cells on a row, others get update_character() for every cell.
+        With '--frame-cycles' frames are drawn every so many cycles of the
+        cpu instead, so the frames of a run do not depend on its speed.
+
+        Keys queued by the terminal go into the keyboard ring in order, one
+        slot after another, until reaching a slot the program has not read
+        yet. With '--replay-keys' they are also queued from a file once the
+        cpu reaches the cycle given for each.
     """
 
     arguments = [
         (["--term"], dict(action="store", default="null", help="Terminal to use (e.g. null, pygame)")),
-        (["--geometry"], dict(action="store", default="80x24", help="Geometry given as `width`x`height`", metavar="SIZE"))]
+        (["--geometry"], dict(action="store", default="80x24", help="Geometry given as `width`x`height`", metavar="SIZE")),
+        (["--frames"], dict(action="store", default="-", help="Where the framebuffer terminal writes frames: a PPM or PNG path numbered by a %%d, or - for ANSI text on stdout", metavar="PATH")),
+        (["--frame-cycles"], dict(action="store", type=int, help="Draw a frame every N cycles instead of in real time", metavar="N")),
+        (["--replay-keys"], dict(action="store", help="Press keys read from FILE, a line of `cycle key` for each", metavar="FILE"))]
 
     def processkeys(self, cpu):
-        keyptr = 0x9000
-        for i in range(0, 16):
-            if not cpu.memory[keyptr + i]:
-                try:
-                    key = self.term.keys.pop()
-                except IndexError:
-                    break
-                cpu.memory[keyptr + i] = key
+        """
+            Write the queued keys to the free slots of the keyboard ring
+        """
+        keys = self.term.keys
+        while keys and not cpu.memory[KEYBOARD_ADDRESS + self.key_slot]:
+            cpu.write(KEYBOARD_ADDRESS + self.key_slot, keys.popleft())
+            self.key_slot = (self.key_slot + 1) % KEYBOARD_SIZE
+
+    def replaykeys(self, cpu):
+        """
+            Queue the replayed keys due by the current cycle
+        """
+        events = self.key_events
+        while events and events[0][0] <= cpu.cycle:
+            self.term.keys.append(events.popleft()[1])
 
     def tick(self, cpu):
         """
-            Update the display every .1s or always if debug is on
+            Update the display at MIN_DISPLAY_HZ, every frame_cycles cycles
+            or always if debug is on
         """
-        if self.debug or not self.time or (time.time() - self.time >= 1.0 / float(MIN_DISPLAY_HZ)):
+        if self.frame_cycles:
+            due = cpu.cycle >= self.next_frame
+            if due:
+                self.next_frame = cpu.cycle - cpu.cycle % self.frame_cycles + self.frame_cycles
+        else:
+            due = self.debug or not self.time or (time.time() - self.time >= 1.0 / float(MIN_DISPLAY_HZ))
+        if due:
             self.time = time.time()
+            self.flush()
             self.term.redraw()
         self.term.updatekeys()
+        if self.key_events:
+            self.replaykeys(cpu)
         if self.term.keys:
             self.processkeys(cpu)
 
     def memory_changed(self, cpu, address, value, oldval):
         """
-            Inform the terminal that the memory is updated
+            Record the write in the shadow video memory
         """
-        if START_ADDRESS <= address <= START_ADDRESS + self.term.width * self.term.height:
-            row, column = divmod(address - START_ADDRESS, self.term.width)
-            ch = value % 0x0080
-            ch = ord(' ') if not ch else ch
-            fg = (value & 0x4000) >> 14 | (value & 0x2000) >> 12 | (value & 0x1000) >> 10
-            bg = (value & 0x400) >> 10 | (value & 0x200) >> 8 | (value & 0x100) >> 6
-            self.term.update_character(row, column, ch, (fg, bg))
+        index = address - START_ADDRESS
+        if 0 <= index < len(self.vram):
+            self.vram[index] = value
+            self.dirty[index] = 1
+
+    @staticmethod
+    def decode(value):
+        """Return the character and the (fg, bg) colors of a video memory word"""
+        ch = value % 0x0080
+        ch = ord(' ') if not ch else ch
+        fg = (value & 0x4000) >> 14 | (value & 0x2000) >> 12 | (value & 0x1000) >> 10
+        bg = (value & 0x400) >> 10 | (value & 0x200) >> 8 | (value & 0x100) >> 6
+        return ch, (fg, bg)
+
+    def flush(self):
+        """
+            Pass the cells changed since the last flush to the terminal
+        """
+        dirty = self.dirty
+        width = self.term.width
+        runs = []
+        start = dirty.find(1)
+        while start != -1:
+            row, column = divmod(start, width)
+            end = dirty.find(0, start, start - column + width)
+            if end == -1:
+                end = start - column + width
+            cells = [self.decode(value) for value in self.vram[start:end]]
+            runs.append((row, column, [ch for ch, color in cells], [color for ch, color in cells]))
+            start = dirty.find(1, end)
+        if not runs:
+            return
+        self.dirty = bytearray(len(dirty))
+
+        if hasattr(self.term, "update_characters"):
+            self.term.update_characters(runs)
+        else:
+            for row, column, characters, colors in runs:
+                for i, ch in enumerate(characters):
+                    self.term.update_character(row, column + i, ch, colors[i])
 
     def shutdown(self):
         """
             Shutdown the terminal
         """
+        self.flush()
         self.term.quit()
 
     def __init__(self, args):
@@ -73,6 +149,10 @@ class TerminalPlugin(BasePlugin):
             print("Terminal %s not available: %s" % (args.term, e))
             raise SystemExit
         self.debug = args.debug
+        self.frame_cycles = args.frame_cycles
+        self.next_frame = 0
+        self.key_slot = 0
+        self.key_events = collections.deque(read_key_events(args.replay_keys) if args.replay_keys else [])
 
         m = re.match(r"(\d+)x(\d+)", args.geometry)
         if m is None:
@@ -84,6 +164,35 @@ class TerminalPlugin(BasePlugin):
 
         self.term = terminal.Terminal(args)
         self.name += "-%s" % args.term
+        self.memory_ranges = [(START_ADDRESS, START_ADDRESS + self.term.width * self.term.height - 1)]
+        # shadow video memory and the cells changed since the last flush
+        self.vram = array("H", [0]) * (self.term.width * self.term.height)
+        self.dirty = bytearray(self.term.width * self.term.height)
+        self.tick_interval = 1 if self.debug else TICK_INTERVAL
         self.term.show()
 
+
+def read_key_events(path):
+    """
+        Read the ``(cycle, key)`` events of a key replay file, in order of
+        cycle
+
+        Each line gives a cycle and a key, either a number or a character
+        in single quotes; blank lines and comments starting with # are
+        skipped.
+    """
+    events = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            m = re.match(r"\s*(?:(\w+)\s+('.'|\w+))?\s*(?:#.*)?$", line)
+            if m is None:
+                raise ValueError("%s:%d: expected `cycle key`: %s" % (path, number, line.strip()))
+            if m.group(1) is None:
+                continue
+            key = m.group(2)
+            events.append((int(m.group(1), 0), ord(key[1]) if key.startswith("'") else int(key, 0)))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
 plugin = TerminalPlugin
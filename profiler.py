@@ -0,0 +1,88 @@
+from __future__ import print_function
+
+import bisect
+import sys
+from array import array
+
+import disasm
+
+
+class Profiler:
+    """
+        Counts the instructions stepped and the cycles charged at every
+        address, when passed to DCPU16.run_until as its recorder
+
+        The counts are kept in flat arrays indexed by address. Each
+        instruction is charged the cycles the engine measured it taking, so
+        cycles fast-forwarded through idle loops are not charged at all and
+        the cpu going back in time does not upset the counts.
+    """
+
+    def __init__(self):
+        self.instructions = array("Q", [0]) * 0x10000
+        self.cycles = array("Q", [0]) * 0x10000
+
+    def record(self, cpu, pc, words, cycles):
+        self.instructions[pc] += 1
+        self.cycles[pc] += cycles
+
+    def hot_spots(self, symbols=None):
+        """
+            Return ``(cycles, instructions, first, last, name)`` for each
+            address run, sorted by cycles, most first
+
+            Without ``symbols`` every address is counted on its own and
+            ``name`` is None. With a dict of label addresses, such as
+            read_symbols returns, addresses are counted against the label
+            at or before them, spanning ``first`` to ``last``.
+        """
+        addresses = [a for a in range(0x10000) if self.instructions[a]]
+        if symbols is None:
+            spots = [(self.cycles[a], self.instructions[a], a, a, None) for a in addresses]
+        else:
+            labels = sorted((address, name) for name, address in symbols.items())
+            starts = [address for address, name in labels]
+            totals = {}
+            for a in addresses:
+                i = bisect.bisect_right(starts, a) - 1
+                key = labels[i] if i >= 0 else (0, None)
+                cycles, instructions, first, last = totals.get(key, (0, 0, a, a))
+                totals[key] = (cycles + self.cycles[a], instructions + self.instructions[a], min(first, a), max(last, a))
+            spots = [total + (key[1],) for key, total in totals.items()]
+        return sorted(spots, key=lambda spot: (-spot[0], spot[2]))
+
+    def report(self, symbols=None, memory=None, count=20, output=sys.stdout):
+        """
+            Print the ``count`` hottest spots found by hot_spots, with the
+            disassembly of the instruction at each address if the spots are
+            single addresses and ``memory`` is given
+        """
+        total = sum(self.cycles) or 1
+        if memory is not None:
+            d = disasm.Disassembler(list(memory) + list(memory[:2]))
+        print("%12s %6s %12s  %s" % ("cycles", "%", "instructions", "address"), file=output)
+        for cycles, instructions, first, last, name in self.hot_spots(symbols)[:count]:
+            if name is not None:
+                where = "%s (%04x-%04x)" % (name, first, last)
+            elif symbols is not None:
+                where = "(%04x-%04x)" % (first, last)
+            elif memory is not None:
+                d.offset = first
+                where = "%04x %s" % (first, (d.next_instruction() or "").split(";")[0].rstrip())
+            else:
+                where = "%04x" % first
+            print("%12d %5.1f%% %12d  %s" % (cycles, 100.0 * cycles / total, instructions, where), file=output)
+
+
+def read_symbols(path):
+    """
+        Read a symbol map, as written by the assemblers' --symbols option,
+        into a dict of label addresses
+    """
+    symbols = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                address, name = line.split()
+                symbols[name] = int(address, 16)
+    return symbols
@@ -1,17 +1,42 @@
+import collections
 import curses
 
 
+def group_runs(runs, attributes):
+    """
+        Split runs of cells into ``(row, column, text, attribute)`` strings
+        of consecutive cells drawn with the same attribute, looked up in
+        ``attributes`` by fg * 8 + bg
+    """
+    for row, column, characters, colors in runs:
+        cells = [attributes[color[0] * 8 + color[1]] if color else attributes[0] for color in colors]
+        start = 0
+        for end in range(1, len(cells) + 1):
+            if end == len(cells) or cells[end] != cells[start]:
+                yield row, column + start, "".join(map(chr, characters[start:end])), cells[start]
+                start = end
+
+
 class Terminal:
     style_bold = False
     keymap = {'A': 0x3, 'C': 0x2, 'D': 0x1}
 
     def setup_colors(self):
+        """
+            Set up a color pair for every fg/bg combination up front, white
+            on black being the default pair, and the attributes drawn with
+            each, indexed by fg * 8 + bg
+        """
         curses.start_color()
         curses.use_default_colors()
         self.colors = {}
         self.colors[(0, 0)] = 0
         self.colors[(7, 0)] = 0
         self.color_index = 1
+        for fg in range(8):
+            for bg in range(8):
+                self.get_color(fg, bg)
+        self.attributes = [self.get_attribute(fg, bg) for fg in range(8) for bg in range(8)]
         self.win.bkgd(curses.color_pair(0))
 
     def __init__(self, args):
@@ -26,7 +51,7 @@ class Terminal:
         curses.noecho()
         self.width = args.width
         self.height = args.height
-        self.keys = []
+        self.keys = collections.deque()
         self.setup_colors()
 
     def get_color(self, fg, bg):
@@ -37,17 +62,25 @@ class Terminal:
 
         return self.colors[(fg, bg)]
 
+    def get_attribute(self, fg, bg):
+        attribute = curses.color_pair(self.get_color(fg, bg))
+        if self.style_bold:
+            attribute |= curses.A_BOLD
+        return attribute
+
     def update_character(self, row, column, character, color=None):
-        try:
-            pair = 0
-            if color:
-                pair = self.get_color(*color)
-            color = curses.color_pair(pair)
-            if self.style_bold:
-                color |= curses.A_BOLD
-            self.win.addch(row, column, character, color)
-        except curses.error:
-            pass
+        self.update_characters([(row, column, [character], [color])])
+
+    def update_characters(self, runs):
+        """
+            Draw every run of cells sharing their colors with one addstr
+        """
+        for row, column, text, attribute in group_runs(runs, self.attributes):
+            try:
+                self.win.addstr(row, column, text, attribute)
+            except curses.error:
+                # writing the bottom right corner fails once drawn
+                pass
 
     def show(self):
         color = curses.color_pair(self.get_color(3, -1))
@@ -81,12 +114,13 @@ class Terminal:
                 char = self.win.getkey()
                 if len(char) == 1:
                     c = self.keymap[char] if char in self.keymap else ord(char)
-                    self.keys.insert(0, c)
+                    self.keys.append(c)
         except curses.error:
             pass
 
     def redraw(self):
-        self.win.refresh()
+        self.win.noutrefresh()
+        curses.doupdate()
 
     def quit(self):
         curses.endwin()
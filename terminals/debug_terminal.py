@@ -1,3 +1,6 @@
+import collections
+
+
 WIDTH = 80
 HEIGHT = 24
 
@@ -5,10 +8,9 @@ HEIGHT = 24
 class Terminal:
     width = WIDTH
     height = HEIGHT
-    keys = []
 
     def __init__(self, args):
-        pass
+        self.keys = collections.deque()
 
     def update_character(self, row, column, character, color=None):
         print("TERMINAL (%d,%d:'%s') %s" % (column, row, chr(character), str(color)))
@@ -0,0 +1,137 @@
+import collections
+import sys
+
+import numpy as np
+
+# control characters are shown as dots in the ANSI output
+PRINTABLE = str.maketrans({c: "." for c in list(range(0x20)) + [0x7f]})
+
+
+class Terminal:
+    """
+        A headless terminal rendering whole frames of video memory with NumPy
+
+        The screen is kept as arrays of characters and fg/bg colors. Each
+        redraw renders a frame by looking the characters up in a table of
+        glyph bitmaps, rasterized once with pygame.font, which needs no
+        display. Frames are written to image files, numbered through a %d
+        in the path given by '--frames', as PPM or, for a .png path, PNG;
+        with '-' they are written to standard output as ANSI text instead,
+        for which pygame is not imported at all.
+    """
+
+    COLORS = [
+        (0, 0, 0),
+        (255, 0, 0),
+        (0, 255, 0),
+        (255, 255, 0),
+        (0, 0, 255),
+        (255, 0, 255),
+        (0, 255, 255),
+        (255, 255, 255)
+    ]
+
+    def __init__(self, args):
+        self.width = args.width
+        self.height = args.height
+        self.keys = collections.deque()
+        self.path = args.frames
+        self.output = sys.stdout
+        self.frame = 0
+        self.changed = False
+
+        self.characters = np.full((self.height, self.width), ord(" "), dtype=np.uint8)
+        self.fg = np.full((self.height, self.width), 7, dtype=np.uint8)
+        self.bg = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.palette = np.array(self.COLORS, dtype=np.uint8)
+        if self.path != "-":
+            self.glyphs = self.build_glyphs()
+
+    def build_glyphs(self):
+        """
+            Rasterize the 128 characters into an array of cell-sized
+            bitmaps, True where the foreground color goes
+        """
+        import pygame
+        pygame.font.init()
+        font = pygame.font.match_font("Monospace,dejavusansmono")
+        font = pygame.font.get_default_font() if not font else font
+        font = pygame.font.Font(font, 12)
+        cell_width = max([font.metrics(chr(c))[0][1] for c in range(0, 128)])
+        cell_height = font.get_height()
+        glyphs = np.zeros((128, cell_height, cell_width), dtype=bool)
+        # the null character cannot be rendered and is left blank
+        for c in range(1, 128):
+            bitmap = pygame.surfarray.array3d(font.render(chr(c), False, (255, 255, 255), (0, 0, 0)))[:, :, 0].T > 127
+            height = min(bitmap.shape[0], cell_height - 1)
+            width = min(bitmap.shape[1], cell_width - 1)
+            glyphs[c, 1:height + 1, 1:width + 1] = bitmap[:height, :width]
+        return glyphs
+
+    def update_character(self, row, column, character, color=None):
+        self.update_characters([(row, column, [character], [color])])
+
+    def update_characters(self, runs):
+        for row, column, characters, colors in runs:
+            end = column + len(characters)
+            self.characters[row, column:end] = characters
+            for i, color in enumerate(colors):
+                if not color or (not color[0] and not color[1]):
+                    color = (7, 0)
+                self.fg[row, column + i], self.bg[row, column + i] = color
+        self.changed = True
+
+    def render(self):
+        """The current screen as an array of RGB pixels, one row of them per line"""
+        mask = self.glyphs[self.characters]
+        # the color of every pixel, laid out (row, y, column, x) so it
+        # reshapes into lines of pixels
+        colors = np.where(mask, self.fg[:, :, np.newaxis, np.newaxis], self.bg[:, :, np.newaxis, np.newaxis])
+        height, width, cell_height, cell_width = mask.shape
+        colors = colors.transpose(0, 2, 1, 3).reshape(height * cell_height, width * cell_width)
+        return self.palette[colors]
+
+    def ansi(self):
+        """The current screen as text with ANSI color escapes"""
+        lines = ["\x1b[H"]
+        colors = self.fg.astype(np.int32) * 8 + self.bg
+        for row in range(self.height):
+            text = self.characters[row].tobytes().decode("latin-1").translate(PRINTABLE)
+            # cells at which the colors change
+            starts = np.flatnonzero(np.diff(colors[row], prepend=-1))
+            ends = list(starts[1:]) + [self.width]
+            for start, end in zip(starts, ends):
+                fg, bg = divmod(colors[row, start], 8)
+                lines.append("\x1b[3%d;4%dm%s" % (fg, bg, text[start:end]))
+            lines.append("\x1b[0m\n")
+        return "".join(lines)
+
+    def write_frame(self):
+        if self.path == "-":
+            self.output.write(self.ansi())
+            self.output.flush()
+        else:
+            path = self.path % self.frame if "%" in self.path else self.path
+            pixels = self.render()
+            if path.endswith(".png"):
+                import pygame
+                pygame.image.save(pygame.surfarray.make_surface(pixels.transpose(1, 0, 2)), path)
+            else:
+                with open(path, "wb") as f:
+                    f.write(b"P6\n%d %d\n255\n" % (pixels.shape[1], pixels.shape[0]))
+                    f.write(pixels.tobytes())
+        self.frame += 1
+        self.changed = False
+
+    def show(self):
+        pass
+
+    def updatekeys(self):
+        pass
+
+    def redraw(self):
+        self.write_frame()
+
+    def quit(self):
+        if self.changed:
+            self.write_frame()
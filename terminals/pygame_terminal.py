@@ -1,3 +1,5 @@
+import collections
+
 import pygame
 
 
@@ -17,7 +19,7 @@ class Terminal:
     def __init__(self, args):
         self.width = args.width
         self.height = args.height
-        self.keys = []
+        self.keys = collections.deque()
         pygame.font.init()
         self.font = pygame.font.match_font("Monospace,dejavusansmono")
         self.font = pygame.font.get_default_font() if not self.font else self.font
@@ -27,19 +29,49 @@ class Terminal:
         win_width = self.cell_width * args.width
         win_height = self.cell_height * args.height
         self.screen = pygame.display.set_mode((win_width, win_height))
+        self.atlas = self.build_atlas()
 
-    def update_character(self, row, column, character, color=None):
+    def build_atlas(self):
+        """
+            Render every character in every fg/bg color pair into one
+            surface, a row of 128 cells for each of the 64 pairs
+
+            The characters are rendered once, in white, and tinted for each
+            foreground color.
+        """
+        width = self.cell_width * 128
+        glyphs = pygame.Surface((width, self.cell_height), pygame.SRCALPHA)
+        # the null character cannot be rendered and is left blank
+        for c in range(1, 128):
+            glyphs.blit(self.font.render(chr(c), True, self.COLORS[7]), (c * self.cell_width + 1, 1))
+        atlas = pygame.Surface((width, self.cell_height * 64)).convert()
+        for fg in range(8):
+            tinted = glyphs.copy()
+            tinted.fill(self.COLORS[fg] + (255,), special_flags=pygame.BLEND_RGBA_MULT)
+            for bg in range(8):
+                y = (fg * 8 + bg) * self.cell_height
+                atlas.fill(self.COLORS[bg], (0, y, width, self.cell_height))
+                atlas.blit(tinted, (0, y))
+        return atlas
+
+    def glyph(self, character, color):
+        """The area of the atlas holding ``character`` in ``color``"""
         if not color or (not color[0] and not color[1]):
-            fgcolor = self.COLORS[7]
-            bgcolor = self.COLORS[0]
+            fg, bg = 7, 0
         else:
-            fgcolor = self.COLORS[color[0]]
-            bgcolor = self.COLORS[color[1]]
-        surf = pygame.Surface((self.cell_width, self.cell_height))
-        surf.fill(pygame.Color(*bgcolor))
-        char = self.font.render(chr(character), True, fgcolor)
-        surf.blit(char, (1, 1))
-        self.screen.blit(surf, (column * self.cell_width, row * self.cell_height))
+            fg, bg = color
+        return (character * self.cell_width, (fg * 8 + bg) * self.cell_height, self.cell_width, self.cell_height)
+
+    def update_character(self, row, column, character, color=None):
+        self.screen.blit(self.atlas, (column * self.cell_width, row * self.cell_height), self.glyph(character, color))
+
+    def update_characters(self, runs):
+        blits = []
+        for row, column, characters, colors in runs:
+            y = row * self.cell_height
+            for i, character in enumerate(characters):
+                blits.append((self.atlas, ((column + i) * self.cell_width, y), self.glyph(character, colors[i])))
+        self.screen.blits(blits, doreturn=False)
 
     def show(self):
         pass
@@ -49,7 +81,7 @@ class Terminal:
         for e in events:
             key = e.unicode
             if key:
-                self.keys.insert(0, ord(e.unicode))
+                self.keys.append(ord(e.unicode))
 
     def redraw(self):
         pygame.display.flip()
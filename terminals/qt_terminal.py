@@ -1,3 +1,4 @@
+import collections
 import sys
 from PyQt4 import QtGui
 from PyQt4.QtCore import Qt
@@ -22,7 +23,7 @@ class Terminal(QtGui.QWidget):
     def __init__(self, args):
         self.width = args.width
         self.height = args.height
-        self.keys = []
+        self.keys = collections.deque()
         self.app = QtGui.QApplication(sys.argv)
         super(Terminal, self).__init__()
 
@@ -36,6 +37,7 @@ class Terminal(QtGui.QWidget):
 
         self.pixmap_buffer = QtGui.QPixmap(win_width, win_height)
         self.pixmap_buffer.fill(Qt.black)
+        self.qcolors = [QtGui.QColor(*color) for color in self.COLORS]
 
         self.resize(win_width, win_height)
         self.setMinimumSize(win_width, win_height)
@@ -46,43 +48,56 @@ class Terminal(QtGui.QWidget):
         self.closed = False
 
     def update_character(self, row, column, character, color=None):
-        char = chr(character)
-        x = column * self.cell_width
-        y = row * self.cell_height
+        self.update_characters([(row, column, [character], [color])])
 
+    def update_characters(self, runs):
+        """
+            Paint runs of cells into the buffer in one painter session and
+            schedule a repaint of the area of each run
+        """
         qp = QtGui.QPainter(self.pixmap_buffer)
         qp.setFont(self.font)
-        if not color or (not color[0] and not color[1]):
-            fgcolor = self.COLORS[7]
-            bgcolor = self.COLORS[0]
-        else:
-            fgcolor = self.COLORS[color[0]]
-            bgcolor = self.COLORS[color[1]]
-        qp.fillRect(x, y, self.cell_width, self.cell_height, QtGui.QColor(*bgcolor))
-        qp.setPen(QtGui.QColor(*fgcolor))
-        qp.drawText(x, y, self.cell_width, self.cell_height, Qt.AlignCenter, char)
+        for row, column, characters, colors in runs:
+            y = row * self.cell_height
+            for i, character in enumerate(characters):
+                color = colors[i]
+                if not color or (not color[0] and not color[1]):
+                    fgcolor = self.qcolors[7]
+                    bgcolor = self.qcolors[0]
+                else:
+                    fgcolor = self.qcolors[color[0]]
+                    bgcolor = self.qcolors[color[1]]
+                x = (column + i) * self.cell_width
+                qp.fillRect(x, y, self.cell_width, self.cell_height, bgcolor)
+                qp.setPen(fgcolor)
+                qp.drawText(x, y, self.cell_width, self.cell_height, Qt.AlignCenter, chr(character))
         qp.end()
+        for row, column, characters, colors in runs:
+            self.update(column * self.cell_width, row * self.cell_height,
+                        len(characters) * self.cell_width, self.cell_height)
 
     def closeEvent(self, e):
         self.closed = True
 
     def keyPressEvent(self, e):
         for c in str(e.text()):
-            self.keys.insert(0, ord(c))
+            self.keys.append(ord(c))
 
     def updatekeys(self):
         pass
 
     def redraw(self):
+        """Repaint the areas changed since the last redraw"""
         if self.closed:
             raise SystemExit
-        self.update()
         self.app.processEvents()
 
     def quit(self):
         self.app.quit()
 
     def paintEvent(self, event):
+        # only the dirty area, which Qt merges from the runs updated
+        rect = event.rect()
         qp = QtGui.QPainter(self)
-        qp.drawPixmap(0, 0, self.pixmap_buffer)
+        qp.drawPixmap(rect, self.pixmap_buffer, rect)
         qp.end()
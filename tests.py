@@ -1,6 +1,14 @@
 import nose.tools as nose
+import collections
 import os
 import subprocess
+import struct
+import time
+from unittest import SkipTest
+
+import dcpu16
+import emuplugin
+import loader
 
 
 ASSEMBLY_OUTPUT = "__test_output.obj"
@@ -45,6 +53,52 @@ def test_fibonacci_asm():
     check_path("./asm.py", example("ique_fibonacci"))
 
 
+def test_asm_fixups_and_cache():
+    import shutil
+    import sys
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, "source.dasm16")
+        output = os.path.join(directory, "source.obj")
+        cache = os.path.join(directory, "cache")
+        with open(source, "w") as f:
+            f.write(":start SET PC, end\n:loop SET [data+I], loop\n:end DAT 0x10, \"a\"\n:data\n")
+        command = [sys.executable, "asm.py", "--cache", cache, "-o", output, source]
+        for i in range(2):
+            nose.assert_equal(subprocess.call(command), 0)
+            nose.assert_equal(list(loader.load(output)), [0x7dc1, 0x0005, 0x7d61, 0x0007, 0x0002, 0x0010, 0x0061])
+            nose.assert_equal(len(os.listdir(cache)), 2)
+
+        with open(source, "w") as f:
+            f.write("SET PC, nowhere\n")
+        nose.assert_equal(subprocess.call(command, stderr=subprocess.PIPE), 1)
+        nose.assert_false(os.path.exists(output))
+        nose.assert_equal(len(os.listdir(cache)), 2)
+
+        # the labels after a syntax error are not reported undefined
+        with open(source, "w") as f:
+            f.write("SET PC, end\nSET A,\n:end SET PC, end\n")
+        process = subprocess.Popen(command, stderr=subprocess.PIPE)
+        err = process.communicate()[1].decode("utf-8")
+        nose.assert_equal(process.returncode, 1)
+        nose.assert_true("Syntax error" in err and "Undefined label" not in err, err)
+        nose.assert_false(os.path.exists(output))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_asm_front_ends():
+    import asm
+    import benchmark
+    # lines line_regex takes apart by backtracking, or rejects
+    lines = [":loopSET A, 1", ":loopSET", ":xDAT 1", "DAT 1 ,2", "DAT 1, \"a;b\" ; c", "DAT \"a", "SET [SP], [12+a]",
+             "SET A, 0x12345", "SET [ 0x10 + j ], 0X1F", "SET A,b;c", "Set A, 1", "SET[A], 1", "jsr  [ l + J ]\n", "", ":l ; c\n"]
+    lines += benchmark.generate_source(1000).splitlines(True)
+    for line in lines:
+        nose.assert_equal(asm.parse_line(line), asm.parse_line_regex(line), line)
+
+
 # asm_pyparsing.py
 def test_example_pyparsing():
     check_path("./asm_pyparsing.py", "example.asm")
@@ -60,3 +114,609 @@ def test_hello2_pyparsing():
 
 def test_fibonacci_pyparsing():
     check_path("./asm_pyparsing.py", example("ique_fibonacci"))
+
+
+# dcpu16.py
+def run_program(program, plugins=[], engine="interpreter"):
+    cpu = dcpu16.DCPU16(program, plugins)
+    cpu.run(engine=engine)
+    return cpu
+
+
+SELF_MODIFYING = [
+    0x8402,                  # :loop ADD A, 1
+    0x7de1, 0x0000, 0x8802,  # SET [loop], 0x8802
+    0x840c,                  # IFE A, 1
+    0x81c1,                  # SET PC, loop
+]
+
+
+def test_self_modifying_code():
+    # ADD A, 1 is rewritten to ADD A, 2 after it has been decoded once
+    cpu = run_program(SELF_MODIFYING)
+    nose.assert_equal(cpu.registers[0x00], 3)
+
+
+def test_self_modifying_code_blocks():
+    cpu = run_program(SELF_MODIFYING, engine="blocks")
+    nose.assert_equal(cpu.registers[0x00], 3)
+    nose.assert_equal(cpu.cycle, run_program(SELF_MODIFYING).cycle)
+    # a loop rewriting its own code on every turn keeps the block index
+    # small, and is interpreted once recompiling it does not pay
+    program = [0x85e2, 0x0003, 0x7c01, 0x0000, 0x7dc1, 0x0000]  # :loop ADD [3], 1 / SET A, 0 / SET PC, loop
+    cpu = dcpu16.DCPU16(program, [])
+    start = time.time()
+    cpu.run_for(cycles=200000, engine="blocks")
+    nose.assert_true(time.time() - start < 5)
+    nose.assert_true(sum(map(len, cpu.block_index.values())) <= 2 * dcpu16.BLOCK_LIMIT)
+    reference = dcpu16.DCPU16(program, [])
+    reference.run_for(cycles=200000)
+    nose.assert_equal(cpu.registers.tobytes(), reference.registers.tobytes())
+
+
+def test_self_modifying_code_table():
+    cpu = run_program(SELF_MODIFYING, engine="table")
+    nose.assert_equal(cpu.registers[0x00], 3)
+    nose.assert_equal(cpu.cycle, run_program(SELF_MODIFYING).cycle)
+
+
+def test_run_for():
+    for engine in dcpu16.ENGINES:
+        cpu = dcpu16.DCPU16([0x7dc1, 0x0000])  # :crash SET PC, crash
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal(result.reason, dcpu16.STOP_CYCLES)
+        nose.assert_equal(result.cycles, 1000)
+        nose.assert_equal(result.instructions, 500)
+        result = cpu.run_for(instructions=10, engine=engine)
+        nose.assert_equal(result.reason, dcpu16.STOP_INSTRUCTIONS)
+        nose.assert_equal(result.instructions, 10)
+
+
+def test_run_until():
+    for engine in dcpu16.ENGINES:
+        cpu = dcpu16.DCPU16(SELF_MODIFYING)
+        result = cpu.run_until(pc=0x0004, engine=engine)
+        nose.assert_equal(result, dcpu16.RunResult(dcpu16.STOP_PC, 5, 2))
+        # starting at the address does not stop the run there again
+        result = cpu.run_until(pc=0x0004, engine=engine)
+        nose.assert_equal(result.reason, dcpu16.STOP_PC)
+        nose.assert_equal(cpu.registers[0x00], 3)
+        result = cpu.run_until(predicate=lambda cpu: False, engine=engine)
+        nose.assert_equal(result.reason, dcpu16.STOP_HALT)
+
+
+def test_breakpoints():
+    program = [
+        0x8061,          # SET I, 0
+        0x8462,          # :loop ADD I, 1
+        0x1961, 0x1000,  # SET [0x1000+I], I
+        0xa86d,          # IFN I, 10
+        0x7dc1, 0x0001,  # SET PC, loop
+        0x7dc1, 0x0007,  # :crash SET PC, crash
+    ]
+    for engine in dcpu16.ENGINES:
+        cpu = dcpu16.DCPU16(program)
+        cpu.breakpoints[0x0001] = lambda cpu: cpu.registers[0x06] == 4
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[0x06]), (dcpu16.STOP_BREAK, 0x0001, 4))
+        cpu.breakpoints.clear()
+        cpu.watchpoints[0x1007] = None
+        cpu.watchpoints[dcpu16.REGISTERS + 0x06] = lambda cpu: cpu.registers[0x06] == 9
+        # the run stops after the instruction making the change
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[dcpu16.PC]), (dcpu16.STOP_BREAK, 0x1007, 0x0004))
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[dcpu16.PC]), (dcpu16.STOP_BREAK, dcpu16.REGISTERS + 0x06, 0x0002))
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[0x06]), (dcpu16.STOP_CYCLES, None, 10))
+
+
+def test_implicit_watchpoints():
+    program = [
+        0x7c01, 0xffff,  # SET A, 0xFFFF
+        0x8402,          # ADD A, 1
+        0x01a1,          # SET PUSH, A
+        0x7dc1, 0x0004,  # :crash SET PC, crash
+    ]
+    for engine in dcpu16.ENGINES:
+        cpu = dcpu16.DCPU16(program)
+        cpu.watchpoints[dcpu16.REGISTERS + dcpu16.O] = None
+        cpu.watchpoints[dcpu16.REGISTERS + dcpu16.SP] = None
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[dcpu16.PC]), (dcpu16.STOP_BREAK, dcpu16.REGISTERS + dcpu16.O, 0x0003))
+        result = cpu.run_for(cycles=1000, engine=engine)
+        nose.assert_equal((result.reason, cpu.hit, cpu.registers[dcpu16.PC]), (dcpu16.STOP_BREAK, dcpu16.REGISTERS + dcpu16.SP, 0x0004))
+
+
+class WatchPlugin(emuplugin.BasePlugin):
+    memory_ranges = [(0x8000, 0x81FF)]
+
+    def __init__(self):
+        emuplugin.BasePlugin.__init__(self)
+        self.writes = []
+
+    def memory_changed(self, cpu, address, value, oldvalue):
+        self.writes.append((address, value, oldvalue))
+
+
+def test_plugin_memory_ranges():
+    program = [
+        0x7c01, 0x8000,          # SET A, 0x8000
+        0x7c81, 0x0041,          # SET [A], 0x41
+        0x7de1, 0x9000, 0x0042,  # SET [0x9000], 0x42
+    ]
+    for engine in dcpu16.ENGINES:
+        plugin = WatchPlugin()
+        cpu = run_program(program, [plugin], engine=engine)
+        nose.assert_equal(plugin.writes, [(0x8000, 0x41, 0x00)])
+        nose.assert_equal(cpu.tickers, [])
+
+
+def test_footprint():
+    import tracemalloc
+    # memory and the per-address flags, with the caches starting empty
+    tracemalloc.start()
+    try:
+        cpu = dcpu16.DCPU16(SELF_MODIFYING, [])
+        size = tracemalloc.get_traced_memory()[0]
+        cpu.run(engine="blocks")
+        run_size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    nose.assert_true(size < 320 * 1024, size)
+    nose.assert_true(run_size < 400 * 1024, run_size)
+
+
+def test_tick_schedule():
+    class Counter(emuplugin.BasePlugin):
+        tick_interval = 1000
+
+        def __init__(self):
+            emuplugin.BasePlugin.__init__(self)
+            self.ticks = 0
+
+        def tick(self, cpu):
+            self.ticks += 1
+
+    # the schedule of periodic plugins carries over between runs
+    counters = []
+    for runs in (1, 1000):
+        counter = Counter()
+        cpu = dcpu16.DCPU16([0x7dc1, 0x0000], [counter])  # :crash SET PC, crash
+        for i in range(runs):
+            cpu.run_for(instructions=500000 // runs)
+        counters.append(counter.ticks)
+    nose.assert_equal(counters, [500, 500])
+
+
+def test_snapshot():
+    cpu = dcpu16.DCPU16(SELF_MODIFYING)
+    cpu.run_for(instructions=1)
+    booted = cpu.snapshot()
+    cpu.run()
+    nose.assert_equal(cpu.registers[0x00], 3)
+    # the rewritten instruction is restored and decoded afresh
+    cpu.restore(booted)
+    nose.assert_equal((cpu.registers[0x00], cpu.cycle), (1, 2))
+    cpu.run()
+    nose.assert_equal(cpu.registers[0x00], 3)
+
+    fork = cpu.fork(booted)
+    fork.run(engine="blocks")
+    nose.assert_equal(fork.registers[0x00], 3)
+    nose.assert_equal(fork.cycle, cpu.cycle)
+    # only the page holding the program differs from the boot snapshot
+    after = fork.snapshot()
+    nose.assert_true(after.pages[0] is not booted.pages[0])
+    nose.assert_true(all(a is b for a, b in zip(after.pages[1:], booted.pages[1:])))
+
+
+def test_throttle():
+    cpu = dcpu16.DCPU16([0x7dc1, 0x0000])  # :crash SET PC, crash
+    start = time.time()
+    cpu.run_for(cycles=5000, clock=100000)
+    # 5000 cycles at 100kHz take 50ms
+    nose.assert_true(time.time() - start >= 0.04)
+    nose.assert_equal(cpu.throttle.missed, 0)
+    nose.assert_true(cpu.throttle.slept > 0)
+
+
+def test_idle_loop():
+    import tracer
+    cpu = dcpu16.DCPU16([0x7dc1, 0x0000])  # :crash SET PC, crash
+    result = cpu.run_for(cycles=10 ** 9, idle=dcpu16.IDLE_HALT)
+    nose.assert_equal(result.reason, dcpu16.STOP_HALT)
+    nose.assert_true(result.cycles < 10 ** 9)
+    cpu = dcpu16.DCPU16([0x7dc1, 0x0000])
+    result = cpu.run_for(cycles=400000, idle=dcpu16.IDLE_SLEEP, engine="blocks")
+    nose.assert_equal(result.reason, dcpu16.STOP_CYCLES)
+    nose.assert_equal(result.instructions * 2, result.cycles)
+    # a loop that changes memory is not idle, and the steps of the probes
+    # finding that out count and are recorded as any others
+    cpu = dcpu16.DCPU16([0x8502, 0x1000, 0x7dc1, 0x0000])  # :loop ADD [0x1000], 1 / SET PC, loop
+    result = cpu.run_for(cycles=300000, idle=dcpu16.IDLE_HALT)
+    nose.assert_equal(result.reason, dcpu16.STOP_CYCLES)
+    nose.assert_equal(result.instructions, 120000)
+    recorder = tracer.TraceRecorder()
+    result = dcpu16.DCPU16([0x8502, 0x1000, 0x7dc1, 0x0000]).run_for(cycles=30000, idle=dcpu16.IDLE_SLEEP, recorder=recorder)
+    nose.assert_equal((result.instructions, recorder.count), (12000, 12000))
+    # but one writing the values already there is
+    result = dcpu16.DCPU16([0x81e1, 0x1000, 0x81c1]).run_for(cycles=10 ** 9, idle=dcpu16.IDLE_HALT)  # :loop SET [0x1000], 0 / SET PC, loop
+    nose.assert_equal(result.reason, dcpu16.STOP_HALT)
+
+
+# plugins/terminalplugin.py
+class BatchTerminal:
+    width = 80
+    height = 24
+
+    def __init__(self):
+        self.runs = []
+        self.keys = collections.deque()
+
+    def update_characters(self, runs):
+        self.runs.extend(runs)
+
+    def updatekeys(self):
+        pass
+
+    def redraw(self):
+        pass
+
+
+def test_terminal_batching():
+    import argparse
+    module = emuplugin._load(os.path.join(emuplugin.PLUGINS_DIR, "terminalplugin.py"))
+    plugin = module.TerminalPlugin(argparse.Namespace(term="debug", geometry="80x24", debug=False, frame_cycles=None, replay_keys=None))
+    plugin.term = BatchTerminal()
+    program = [
+        0x7c01, 0x8000,          # SET A, 0x8000
+        0x7c81, 0x4141,          # SET [A], 0x4141
+        0x7de1, 0x8001, 0x0042,  # SET [0x8001], 0x42
+        0x7de1, 0x8001, 0x0043,  # SET [0x8001], 0x43
+        0x7de1, 0x8050, 0x0044,  # SET [0x8050], 0x44
+    ]
+    run_program(program, [plugin])
+    nose.assert_equal(plugin.term.runs, [])
+    plugin.flush()
+    # the overwritten cell is drawn once, in a run with its neighbour
+    nose.assert_equal(plugin.term.runs, [(0, 0, [0x41, 0x43], [(1, 4), (0, 0)]), (1, 0, [0x44], [(0, 0)])])
+    plugin.flush()
+    nose.assert_equal(len(plugin.term.runs), 2)
+
+
+def test_terminal_key_replay():
+    import argparse
+    import tempfile
+    module = emuplugin._load(os.path.join(emuplugin.PLUGINS_DIR, "terminalplugin.py"))
+    with tempfile.NamedTemporaryFile("w", suffix=".keys", delete=False) as f:
+        f.write("# cycle key\n0 'a'\n5000 '#'  # a late one\n\n0 0x42\n20000 3\n")
+    try:
+        plugin = module.TerminalPlugin(argparse.Namespace(term="debug", geometry="80x24", debug=False, frame_cycles=None, replay_keys=f.name))
+    finally:
+        os.remove(f.name)
+    plugin.term = BatchTerminal()
+    cpu = dcpu16.DCPU16([0x81c1], [plugin])  # :loop SET PC, loop
+    cpu.memory[0x9001] = 0x99
+    cpu.run_for(cycles=3000)
+    # the key after the one not read yet waits for it to be
+    nose.assert_equal(list(cpu.memory[0x9000:0x9003]), [0x61, 0x99, 0x00])
+    nose.assert_equal(list(plugin.term.keys), [0x42])
+    cpu.memory[0x9001] = 0
+    cpu.run_for(cycles=10000)
+    nose.assert_equal(list(cpu.memory[0x9000:0x9004]), [0x61, 0x42, 0x23, 0x00])
+    nose.assert_equal(list(plugin.key_events), [(20000, 3)])
+
+
+# plugins/debuggerplugin.py
+def test_debugger_watch():
+    import argparse
+    module = emuplugin._load(os.path.join(emuplugin.PLUGINS_DIR, "debuggerplugin.py"))
+    plugin = module.DebuggerPlugin(argparse.Namespace(debug=True, history=1, checkpoint_interval=1000))
+    plugin.cpu = dcpu16.DCPU16([], [])
+    plugin.debugger_watch("%sp", "%o")
+    nose.assert_equal(sorted(plugin.cpu.watchpoints), [dcpu16.REGISTERS + dcpu16.SP, dcpu16.REGISTERS + dcpu16.O])
+    nose.assert_raises(ValueError, plugin.debugger_watch, "%pc")
+
+
+# terminals/curses_terminal.py
+def test_curses_group_runs():
+    try:
+        module = emuplugin._load(os.path.join("terminals", "curses_terminal.py"))
+    except ImportError:
+        raise SkipTest("the curses terminal needs curses")
+
+    # white on black and the default colors draw with the same attribute
+    attributes = list(range(64))
+    attributes[7 * 8] = attributes[0]
+    runs = [(0, 1, [ord("A"), ord("B"), ord("C"), ord("D")], [(1, 4), (1, 4), (7, 0), None]),
+            (2, 0, [ord("E"), ord("F")], [(2, 0), (1, 4)])]
+    nose.assert_equal(list(module.group_runs(runs, attributes)),
+                      [(0, 1, "AB", 12), (0, 3, "CD", 0), (2, 0, "E", 16), (2, 1, "F", 12)])
+    nose.assert_equal(list(module.group_runs([], attributes)), [])
+
+
+# terminals/framebuffer_terminal.py
+def test_framebuffer_terminal():
+    import argparse
+    import io
+    import tempfile
+    try:
+        module = emuplugin._load(os.path.join("terminals", "framebuffer_terminal.py"))
+    except ImportError:
+        raise SkipTest("the framebuffer terminal needs numpy and pygame")
+
+    path = os.path.join(tempfile.mkdtemp(), "frame%d.ppm")
+    term = module.Terminal(argparse.Namespace(width=4, height=2, frames=path))
+    term.update_characters([(0, 1, [ord("A"), ord(" ")], [(1, 4), (0, 0)])])
+    term.redraw()
+    term.quit()
+    with open(path % 0, "rb") as f:
+        header = [f.readline() for i in range(3)]
+        pixels = f.read()
+    cell_height, cell_width = term.glyphs.shape[1:]
+    nose.assert_equal(header, [b"P6\n", b"%d %d\n" % (4 * cell_width, 2 * cell_height), b"255\n"])
+    nose.assert_equal(len(pixels), 4 * cell_width * 2 * cell_height * 3)
+    # the corner of the blue cell, and of the cell after it
+    nose.assert_equal(pixels[cell_width * 3:cell_width * 3 + 3], b"\x00\x00\xff")
+    nose.assert_equal(pixels[cell_width * 6:cell_width * 6 + 3], b"\x00\x00\x00")
+    # nothing changed, so quitting wrote no last frame
+    nose.assert_false(os.path.exists(path % 1))
+    os.remove(path % 0)
+    os.rmdir(os.path.dirname(path))
+
+    term = module.Terminal(argparse.Namespace(width=4, height=2, frames="-"))
+    term.output = io.StringIO()
+    term.update_characters([(0, 1, [ord("A"), ord("B")], [(1, 4), (1, 4)])])
+    term.redraw()
+    nose.assert_equal(term.output.getvalue(), "\x1b[H\x1b[37;40m \x1b[31;44mAB\x1b[37;40m \x1b[0m\n\x1b[37;40m    \x1b[0m\n")
+    # control characters in video memory do not reach the terminal
+    term.output = io.StringIO()
+    term.update_characters([(1, 0, [0x1b, 0x07, 0x7f], [(7, 0)] * 3)])
+    term.redraw()
+    nose.assert_equal(term.output.getvalue().split("\n")[1], "\x1b[37;40m... \x1b[0m")
+
+
+# terminals/pygame_terminal.py
+def test_pygame_terminal():
+    import argparse
+    # no window is opened with the dummy video driver
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        module = emuplugin._load(os.path.join("terminals", "pygame_terminal.py"))
+    except ImportError:
+        raise SkipTest("the pygame terminal needs pygame")
+    import pygame
+
+    term = module.Terminal(argparse.Namespace(width=4, height=2))
+    try:
+        # a row of 128 cells for each of the 64 color pairs
+        nose.assert_equal(term.atlas.get_size(), (term.cell_width * 128, term.cell_height * 64))
+        x, y, width, height = term.glyph(ord("A"), (1, 4))
+        nose.assert_equal((y, width, height), (12 * term.cell_height, term.cell_width, term.cell_height))
+        cell = [tuple(term.atlas.get_at((x + i, y + j)))[:3] for j in range(height) for i in range(width)]
+        nose.assert_equal(cell[0], (0, 0, 255))
+        nose.assert_true((255, 0, 0) in cell)
+        # the default colors and white on black share a row
+        nose.assert_equal(term.glyph(ord("A"), None), term.glyph(ord("A"), (7, 0)))
+
+        term.update_characters([(1, 2, [ord("A"), ord(" ")], [(1, 4), None])])
+        drawn = [tuple(term.screen.get_at((2 * width + i, height + j)))[:3] for j in range(height) for i in range(width)]
+        nose.assert_equal(drawn, cell)
+        nose.assert_equal(tuple(term.screen.get_at((3 * width, height)))[:3], (0, 0, 0))
+    finally:
+        pygame.display.quit()
+
+
+# terminals/qt_terminal.py
+def test_qt_terminal():
+    import argparse
+    if not os.environ.get("DISPLAY"):
+        raise SkipTest("the qt terminal needs a display")
+    try:
+        module = emuplugin._load(os.path.join("terminals", "qt_terminal.py"))
+    except ImportError:
+        raise SkipTest("the qt terminal needs PyQt4")
+    from PyQt4 import QtGui
+
+    term = module.Terminal(argparse.Namespace(width=4, height=2))
+    areas = []
+    term.update = lambda *area: areas.append(area)
+    term.update_characters([(0, 1, [ord("A"), ord("B")], [(1, 4), (1, 4)]), (1, 0, [ord("C")], [None])])
+    width, height = term.cell_width, term.cell_height
+    # one repaint scheduled for each run, covering all of its cells
+    nose.assert_equal(areas, [(width, 0, 2 * width, height), (0, height, width, height)])
+    image = term.pixmap_buffer.toImage()
+    nose.assert_equal(QtGui.QColor(image.pixel(width, 0)).getRgb()[:3], (0, 0, 255))
+    nose.assert_equal(QtGui.QColor(image.pixel(3 * width, 0)).getRgb()[:3], (0, 0, 0))
+    term.quit()
+
+
+# loader.py
+def test_loader():
+    path = os.path.join(BINARY_DIR, "example.bin")
+    with open(path, "rb") as f:
+        data = f.read()
+    words = loader.load(path)
+    nose.assert_equal(list(words), list(struct.unpack(">%dH" % (len(data) // 2), data)))
+    at = loader.load(path, 0x100)
+    nose.assert_equal(len(at), 0x100 + len(words))
+    nose.assert_equal(at[0x100:], words)
+    nose.assert_equal(len(loader.load(path, 0xFFFF)), 0x10000)
+
+
+# lockstep.py
+def test_lockstep():
+    try:
+        import lockstep
+    except ImportError:
+        raise SkipTest("lockstep needs numpy")
+
+    # a different program on each machine, so their PCs diverge at once
+    programs = [loader.load(os.path.join(BINARY_DIR, name)) for name in sorted(os.listdir(BINARY_DIR))]
+    programs.append(SELF_MODIFYING)
+    memory = [list(p) + [0] * (0x1000 - len(p)) for p in programs]
+    batch = lockstep.Lockstep(memory)
+    results = batch.run(instructions=2000)
+    for i, program in enumerate(programs):
+        cpu = dcpu16.DCPU16(program)
+        nose.assert_equal(results[i], cpu.run_for(instructions=2000))
+        nose.assert_equal(batch.registers[i].tolist(), list(cpu.registers))
+        nose.assert_equal(batch.memory[i].tolist(), list(cpu.memory))
+
+
+# batch.py
+def test_batch():
+    import batch
+    paths = batch.find_images([BINARY_DIR])
+    nose.assert_equal(len(paths), len(os.listdir(BINARY_DIR)))
+    results = sorted(batch.run_batch(paths, cycles=10000, processes=2), key=lambda r: r["file"])
+    nose.assert_equal([r["file"] for r in results], paths)
+    for result in results:
+        nose.assert_equal(result["reason"], dcpu16.STOP_CYCLES)
+        nose.assert_equal(result["hash"], batch.run_image(result["file"], cycles=10000)["hash"])
+
+
+# tracer.py
+def test_trace_recorder():
+    import io
+    import tracer
+    recorder = tracer.TraceRecorder(capacity=4)
+    cpu = dcpu16.DCPU16(SELF_MODIFYING)
+    result = cpu.run(engine="blocks", recorder=recorder)
+    nose.assert_equal(recorder.count, result.instructions)
+    records = list(tracer.read_records(recorder.records()))
+    nose.assert_equal(len(records), 4)
+    nose.assert_equal([r[1] for r in records], [0x0000, 0x0001, 0x0004, 0x0005])
+    nose.assert_equal(records[-1][0], cpu.cycle)
+    output = io.StringIO()
+    tracer.render(records, output)
+    lines = output.getvalue().splitlines()
+    # the second ADD is recorded as rewritten, and the IFE skip is shown
+    nose.assert_true(lines[0].startswith("(%08X) ADD A, 0x02" % records[0][0]))
+    nose.assert_true(lines[2].startswith("(%08X) IFE A, 0x01" % records[2][0]))
+    nose.assert_true(lines[3].endswith("skipped"))
+    # an instruction rewriting itself is recorded as executed
+    recorder = tracer.TraceRecorder()
+    dcpu16.DCPU16([0x7de1, 0x0000, 0x8402]).run(recorder=recorder)  # SET [0x0000], 0x8402
+    nose.assert_equal(next(tracer.read_records(recorder.records()))[3], (0x7de1, 0x0000, 0x8402))
+
+
+# history.py
+def test_history():
+    import history
+    plugins = []
+    cpu = dcpu16.DCPU16(SELF_MODIFYING, plugins)
+    recorder = history.History(cpu, interval=2)
+    plugins.append(recorder)
+    cpu.run_for(instructions=2)
+    before = (cpu.registers.tobytes(), cpu.cycle)
+    cpu.write(0x1000, 0x1234)
+    cpu.run()
+    nose.assert_equal(cpu.registers[0x00], 3)
+    nose.assert_equal([c.instructions for c in recorder.checkpoints], [0, 2, 4, 6, 8])
+    # the journaled write is made again on the way back
+    nose.assert_equal(recorder.back(5), 5)
+    nose.assert_equal(cpu.instructions, 3)
+    nose.assert_equal(cpu.memory[0x1000], 0x1234)
+    recorder.go(2)
+    nose.assert_equal((cpu.registers.tobytes(), cpu.cycle), before)
+    nose.assert_equal(cpu.memory[0x1000], 0x1234)
+    nose.assert_equal([c.instructions for c in recorder.checkpoints], [0, 2])
+    cpu.breakpoints[0x0004] = None
+    cpu.run()
+    nose.assert_equal(cpu.hit, 0x0004)
+    cpu.run()
+    nose.assert_equal(recorder.back_to_hit(), 0x0004)
+    nose.assert_equal((cpu.registers[dcpu16.PC], cpu.instructions), (0x0004, 6))
+    nose.assert_equal(recorder.back_to_hit(), 0x0004)
+    nose.assert_equal(cpu.instructions, 2)
+    nose.assert_equal(recorder.back_to_hit(), None)
+    nose.assert_equal(cpu.instructions, 0)
+
+
+def test_history_ticker_writes():
+    import history
+
+    class Ticker(emuplugin.BasePlugin):
+        """Writes 7 to 0x9000 on its 50th tick, after every instruction"""
+        def __init__(self):
+            emuplugin.BasePlugin.__init__(self)
+            self.ticks = 0
+
+        def tick(self, cpu):
+            self.ticks += 1
+            if self.ticks == 50:
+                cpu.write(0x9000, 7)
+
+    program = [0x7802, 0x9000, 0x81c1]  # :loop ADD A, [0x9000]; SET PC, loop
+    for engine in dcpu16.ENGINES:
+        fresh = dcpu16.DCPU16(program, [Ticker()])
+        fresh.run_for(instructions=200, engine=engine)
+        plugins = [Ticker()]
+        cpu = dcpu16.DCPU16(program, plugins)
+        recorder = history.History(cpu, interval=100)
+        plugins.append(recorder)
+        cpu.run_for(instructions=300, engine=engine)
+        # the write is journaled at the instruction the ticker made it
+        nose.assert_equal(recorder.checkpoints[0].journal, [(50, 0x9000, 7)])
+        recorder.go(200)
+        nose.assert_equal(cpu.registers.tobytes(), fresh.registers.tobytes())
+
+
+# profiler.py
+def test_profiler():
+    import profiler
+    cpu = dcpu16.DCPU16(SELF_MODIFYING)
+    p = profiler.Profiler()
+    result = cpu.run(recorder=p)
+    nose.assert_equal(sum(p.cycles), cpu.cycle)
+    nose.assert_equal(sum(p.instructions), result.instructions)
+    nose.assert_equal(p.hot_spots()[0][2:4], (0x0001, 0x0001))
+    spots = p.hot_spots({"loop": 0x0000, "check": 0x0004})
+    nose.assert_equal([spot[2:] for spot in spots], [(0x0000, 0x0001, "loop"), (0x0004, 0x0005, "check")])
+    nose.assert_equal(spots[0][0] + spots[1][0], cpu.cycle)
+    # going back in time mid-profile does not upset the counts
+    cpu = dcpu16.DCPU16(SELF_MODIFYING)
+    p = profiler.Profiler()
+    snapshot = cpu.snapshot()
+    cpu.run_for(instructions=20, recorder=p)
+    cpu.restore(snapshot)
+    cpu.run_for(instructions=20, recorder=p)
+    nose.assert_equal(sum(p.cycles), 2 * cpu.cycle)
+    # and cycles fast-forwarded through an idle loop are not charged
+    cpu = dcpu16.DCPU16([0x7dc1, 0x0000])  # :crash SET PC, crash
+    p = profiler.Profiler()
+    result = cpu.run_for(cycles=400000, idle=dcpu16.IDLE_SLEEP, recorder=p)
+    nose.assert_equal(sum(p.cycles), 2 * sum(p.instructions))
+    nose.assert_true(sum(p.cycles) < result.cycles)
+
+
+# benchmark.py
+def test_benchmark_compare():
+    import benchmark
+    old = {"a": {"value": 100.0, "unit": "kHz"}, "b": {"value": 100.0, "unit": "kHz"}, "c": {"value": 1.0, "unit": "kHz"}}
+    new = {"a": {"value": 96.0, "unit": "kHz"}, "b": {"value": 90.0, "unit": "kHz"}}
+    rows, regressions = benchmark.compare(old, new, 0.05)
+    nose.assert_equal([row[0] for row in rows], ["a", "b"])
+    nose.assert_equal(regressions, ["b"])
+
+
+def test_benchmark_workloads():
+    import benchmark
+    # the largest generated source keeps its lines but fits in memory
+    source = benchmark.generate_source(benchmark.ASM_SIZES[-1])
+    nose.assert_equal(len(source.splitlines()), benchmark.ASM_SIZES[-1])
+    elapsed, program = benchmark.assemble(source)
+    nose.assert_true(elapsed is not None, program)
+    nose.assert_true(len(program) <= benchmark.ASM_WORDS)
+
+    # speeds count the cycles run, not the budget: this counts to 100 and halts
+    program = [0x8001, 0x8402, 0x7c0d, 0x0064, 0x85c1, 0x0000]
+    best_of = benchmark.best_of
+    benchmark.best_of = lambda func: func() or 1.0
+    try:
+        speed = benchmark.bench_emulator(program, "interpreter", cycles=100000)
+    finally:
+        benchmark.best_of = best_of
+    nose.assert_true(0 < speed < 1, speed)
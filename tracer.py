@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import struct
+import sys
+from array import array
+
+import disasm
+
+
+# identifies trace files, followed by the byte order of the register dumps
+MAGIC = b"DCPU16TRACE\x00"
+
+FILE_HEADER = struct.Struct("<12s4s")
+
+# cycle count after the instruction, its address, whether the next
+# instruction is skipped, and the three words at the address
+RECORD_HEADER = struct.Struct("<QHHHHH")
+
+# followed by the whole register file, as in DCPU16.registers, after the
+# instruction
+RECORD_SIZE = RECORD_HEADER.size + 0x20 * 2
+
+# records kept by a ring buffer unless told otherwise
+RING_RECORDS = 0x10000
+
+# records buffered before being appended to a trace file
+FILE_RECORDS = 0x1000
+
+# registers whose changes are shown by render, with their offsets in the dumps
+REGISTERS = list(zip(["A", "B", "C", "X", "Y", "Z", "I", "J", "SP", "O"], list(range(8)) + [0x1B, 0x1D]))
+
+
+class TraceRecorder:
+    """
+        Records each instruction a DCPU16 interprets as a fixed-size binary
+        record
+
+        Records go into a preallocated buffer of ``capacity`` records. Without
+        a ``path`` the buffer is a ring keeping the latest of them; with one,
+        a full buffer is appended to the file, which holds the whole run
+        once the recorder is closed.
+    """
+
+    def __init__(self, capacity=None, path=None):
+        if capacity is None:
+            capacity = RING_RECORDS if path is None else FILE_RECORDS
+        self.buffer = bytearray(capacity * RECORD_SIZE)
+        self.offset = 0
+        self.count = 0
+        self.file = None
+        if path is not None:
+            self.file = open(path, "wb")
+            self.file.write(FILE_HEADER.pack(MAGIC, sys.byteorder[0].encode("ascii")))
+
+    def record(self, cpu, pc, words, cycles):
+        """
+            Record the instruction just executed at ``pc`` by ``cpu``, where
+            ``words`` are the three words at ``pc`` it was executed from and
+            ``cycles`` the cycles it took
+        """
+        offset = self.offset
+        RECORD_HEADER.pack_into(self.buffer, offset, cpu.cycle, pc, cpu.skip, *words)
+        offset += RECORD_HEADER.size
+        self.buffer[offset:offset + 0x40] = cpu.registers.tobytes()
+        self.offset = offset = offset + 0x40
+        self.count += 1
+        if offset == len(self.buffer):
+            if self.file is not None:
+                self.file.write(self.buffer)
+            self.offset = 0
+
+    def records(self):
+        """The raw records held in the ring, oldest first"""
+        if self.count * RECORD_SIZE >= len(self.buffer):
+            data = self.buffer[self.offset:] + self.buffer[:self.offset]
+        else:
+            data = self.buffer[:self.offset]
+        return bytes(data)
+
+    def save(self, path):
+        """Write the records held in the ring to a trace file"""
+        with open(path, "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, sys.byteorder[0].encode("ascii")))
+            f.write(self.records())
+
+    def close(self):
+        """Append the buffered records to the trace file and close it"""
+        if self.file is not None:
+            self.file.write(self.buffer[:self.offset])
+            self.file.close()
+            self.file = None
+            self.offset = 0
+
+
+def read_records(data, byteorder=sys.byteorder):
+    """
+        Yield ``(cycle, pc, skip, words, registers)`` for each record in
+        ``data``, with the register dumps in ``byteorder``
+    """
+    for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        cycle, pc, skip, w0, w1, w2 = RECORD_HEADER.unpack_from(data, offset)
+        registers = array("H")
+        registers.frombytes(data[offset + RECORD_HEADER.size:offset + RECORD_SIZE])
+        if byteorder != sys.byteorder:
+            registers.byteswap()
+        yield cycle, pc, bool(skip), (w0, w1, w2), registers
+
+
+def read_trace(path):
+    """Yield the records of the trace file at ``path``, as read_records does"""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, byteorder = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("%s is not a trace file" % path)
+    byteorder = "little" if byteorder.rstrip(b"\x00") == b"l" else "big"
+    return read_records(data[FILE_HEADER.size:], byteorder)
+
+
+def render(records, output=sys.stdout):
+    """
+        Print a line for every record: the cycle count after the
+        instruction, its disassembly and the registers it changed
+    """
+    program = [0] * 0x10002
+    d = disasm.Disassembler(program)
+    previous = None
+    skipping = False
+    for cycle, pc, skip, words, registers in records:
+        program[pc:pc + 3] = words
+        d.offset = pc
+        line = "(%08X) %s" % (cycle, d.next_instruction() or "DAT 0x%04x" % words[0])
+        if skipping:
+            line += " skipped"
+        elif previous is not None:
+            changes = ["%s=%04X" % (name, registers[i]) for name, i in REGISTERS if registers[i] != previous[i]]
+            if changes:
+                line += " " + " ".join(changes)
+        print(line, file=output)
+        previous = registers
+        skipping = skip
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DCPU-16 binary trace decoder")
+    parser.add_argument("-o", help="Place the output into FILE instead of stdout", metavar="FILE")
+    parser.add_argument("input", help="Trace file written by 'dcpu16.py --trace-file'")
+    args = parser.parse_args()
+
+    output = sys.stdout if args.o is None else open(args.o, "w")
+    render(read_trace(args.input), output)